@@ -0,0 +1,42 @@
+"""Check of the events WebSocket route, which needs no database.
+
+Connects to /events/ without a token, which the route closes with
+the policy violation code, unlike paths served by no route.
+
+Run from the project root: python -m benchmarks.events_route
+"""
+
+import os
+import sys
+
+for variable in ('POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_DB'):
+	os.environ.setdefault(variable, 'quicksell')
+os.environ['BROKER'] = 'local'
+
+# pylint: disable=wrong-import-position
+from fastapi.testclient import TestClient
+from starlette.status import WS_1008_POLICY_VIOLATION
+from starlette.websockets import WebSocketDisconnect
+
+from quicksell.main import app
+
+
+def close_code(client: TestClient, path: str) -> int:
+	try:
+		with client.websocket_connect(path) as websocket:
+			websocket.receive_text()
+	except WebSocketDisconnect as disconnect:
+		return disconnect.code
+	return None
+
+
+def main():
+	client = TestClient(app)  # not entered, so the app isn't started
+	code = close_code(client, '/events/')
+	print(f"/events/ closed with {code}")
+	if code != WS_1008_POLICY_VIOLATION:
+		sys.exit(f"/events/ isn't served, expected {WS_1008_POLICY_VIOLATION}")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,207 @@
+"""Regression check of the query plans of the listings search.
+
+Seeds a large synthetic set of listings, analyzes it and explains pages
+of GET /listings/ built by the route's own listing_search, first ones
+and ones following a cursor. Exits with 1 if any of them scans the whole
+table or uses none of the indexes expected for it, so it can be run by
+CI after migrating. Everything is rolled back.
+
+Run from the project root against a migrated database:
+python -m benchmarks.listing_plans
+"""
+
+import os
+import sys
+from time import time
+
+for variable in ('POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_DB'):
+	os.environ.setdefault(variable, 'quicksell')
+
+# pylint: disable=wrong-import-position
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import select, text
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from quicksell.categories import categories
+from quicksell.database import Database
+from quicksell.models import Category, Listing, Profile
+from quicksell.routes.base import Identity
+from quicksell.routes.listings import listing_search
+
+ROWS = 200000
+SELLERS = 2000
+STATE_TYPE = Listing.__table__.c.state.type.name
+
+LATEST = 'ix_Listing_active_ts_spawn'
+CATEGORY_LATEST = 'ix_Listing_active_category_id_ts_spawn'
+CATEGORY_CHEAPEST = 'ix_Listing_active_category_id_price'
+SELLER_LATEST = 'ix_Listing_active_seller_id_ts_spawn'
+NEW_LATEST = 'ix_Listing_active_is_new_ts_spawn'
+CHEAPEST = 'ix_Listing_active_price'
+TITLE = {'ix_Listing_search_vector', 'ix_Listing_title_trgm'}
+NEARBY = 'ix_Listing_earth_point'
+
+
+class Explain(Executable, ClauseElement):
+	"""EXPLAIN ANALYZE of the query, plan as JSON."""
+
+	inherit_cache = False
+
+	def __init__(self, query):
+		self.query = query
+
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element, compiler, **kwargs):
+	return 'EXPLAIN (ANALYZE, FORMAT JSON) ' + compiler.process(
+		element.query, **kwargs
+	)
+
+
+def seed(connection) -> tuple[list[int], list[int]]:
+	"""Insert sellers and listings, return their and categories' ids."""
+	category_ids = connection.execute(
+		select(Category.id).where(Category.assignable)
+	).scalars().all()
+	if not category_ids:
+		sys.exit("No categories, run python -m quicksell migrate first")
+	seller_ids = connection.execute(text("""
+		INSERT INTO "Profile" (uuid, phone, name, about, online, rating)
+		SELECT gen_random_uuid(), '+7000' || lpad(n::text, 7, '0'), 'Seller', '',
+			true, 0
+		FROM generate_series(1, :sellers) n
+		RETURNING id
+	"""), {'sellers': SELLERS}).scalars().all()
+	connection.execute(text(f"""
+		INSERT INTO "Listing" (
+			uuid, seller_id, category_id, state, ts_spawn, title, description,
+			price, is_new, quantity, sold, views, latitude, longitude
+		)
+		SELECT
+			gen_random_uuid(),
+			(:sellers)[1 + n % cardinality(:sellers)],
+			(:categories)[1 + n % cardinality(:categories)],
+			(ARRAY['active', 'active', 'active', 'closed', 'sold', 'deleted'])
+				[1 + n % 6]::"{STATE_TYPE}",
+			extract(epoch FROM now())::bigint - (random() * 365 * 86400)::bigint,
+			'Listing ' || n, 'Description of listing ' || n,
+			(random() * 100000)::int, n % 3 = 0, 1, 0, (random() * 1000)::int,
+			55 + random() * 5, 37 + random() * 5
+		FROM generate_series(1, :rows) n
+	"""), {'sellers': seller_ids, 'categories': category_ids, 'rows': ROWS})
+	connection.execute(text('ANALYZE "Listing", "Profile"'))
+	return seller_ids, category_ids
+
+
+def load_categories(connection):
+	"""Fill the registry the route resolves category names by."""
+	categories.build([
+		Category(id=row.id, name=row.name, parent_id=row.parent_id)
+		for row in connection.execute(
+			select(Category.id, Category.name, Category.parent_id)
+			.order_by(Category.id)
+		)
+	])
+
+
+def queries(connection, seller_ids: list[int], category_ids: list[int]):
+	"""Name, query and expected indexes of each kind of the route's pages."""
+	load_categories(connection)
+	seller_uuid = connection.execute(
+		select(Profile.uuid).where(Profile.id == seller_ids[0])
+	).scalar()
+	seller = Identity('', 0, seller_ids[1], None)
+	names = [
+		category.name for category in categories.by_name.values()
+		if category.id in category_ids[:3]
+	]
+	prices = {'min_price': 1000, 'max_price': 5000}
+	title = {'title': 'Listing 4242'}
+	nearby = {'latitude': 57.5, 'longitude': 39.5, 'distance': 5000}
+	month_ago = int(time()) - 30 * 86400
+	cases = {  # user, search parameters, cursor key, expected indexes
+		'latest': (None, {}, None, {LATEST}),
+		'latest, next page': (
+			None, {}, ('-ts_spawn', month_ago, ROWS), {LATEST}
+		),
+		'own and published': (seller, {}, None, {LATEST, SELLER_LATEST}),
+		'category': (None, {'category': names}, None, {CATEGORY_LATEST}),
+		'category, next page': (
+			None, {'category': names}, ('-ts_spawn', month_ago, ROWS),
+			{CATEGORY_LATEST}
+		),
+		'category, cheapest': (
+			None, {'category': names, 'order_by': 'price'}, None,
+			{CATEGORY_CHEAPEST}
+		),
+		'category, price range': (
+			None, {'category': names, **prices}, None,
+			{CATEGORY_LATEST, CATEGORY_CHEAPEST}
+		),
+		'price range': (None, prices, None, {LATEST, CHEAPEST}),
+		'price range, cheapest': (
+			None, {**prices, 'order_by': 'price'}, None, {CHEAPEST}
+		),
+		'cheapest, next page': (
+			None, {'order_by': 'price'}, ('price', 50000, ROWS), {CHEAPEST}
+		),
+		'new': (None, {'is_new': True}, None, {LATEST, NEW_LATEST}),
+		'new, price range': (
+			None, {'is_new': True, **prices}, None, {LATEST, NEW_LATEST, CHEAPEST}
+		),
+		'seller': (None, {'seller_uuid': seller_uuid}, None, {SELLER_LATEST}),
+		'title': (None, title, None, TITLE),
+		'title, relevance': (None, {**title, 'order_by': 'relevance'}, None, TITLE),
+		'nearby': (None, {**nearby, 'order_by': 'distance'}, None, {NEARBY}),
+	}
+	for name, (user, parameters, after, expected) in cases.items():
+		filters, columns, order_by = listing_search(user, **parameters)
+		query = Listing.page_query(
+			*filters, order_by=order_by, after=after, columns=columns
+		)
+		yield name, query, expected
+
+
+def nodes(plan: dict):
+	yield plan
+	for child in plan.get('Plans', ()):
+		yield from nodes(child)
+
+
+def explain(connection, query) -> tuple[float, list[str], bool]:
+	"""Execution time, indexes used and whether Listing was scanned."""
+	(result,) = connection.execute(Explain(query)).scalar_one()
+	plan = list(nodes(result['Plan']))
+	indexes = sorted({node['Index Name'] for node in plan if 'Index Name' in node})
+	scanned = any(
+		node['Node Type'] == 'Seq Scan' and node.get('Relation Name') == 'Listing'
+		for node in plan
+	)
+	return result['Execution Time'], indexes, scanned
+
+
+def main():
+	Database.connect()
+	failed = []
+	with Database.engine.connect() as connection:
+		try:
+			print(f"Seeding {ROWS} listings...")
+			seller_ids, category_ids = seed(connection)
+			for name, query, expected in queries(
+				connection, seller_ids, category_ids
+			):
+				milliseconds, indexes, scanned = explain(connection, query)
+				if scanned or not expected.intersection(indexes):
+					failed.append(name)
+				print(
+					f"{name:24} {milliseconds:8.2f} ms "
+					f"{'SEQ SCAN' if scanned else ', '.join(indexes)}"
+				)
+		finally:
+			connection.rollback()
+	if failed:
+		sys.exit(f"Sequential scans or unexpected indexes: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+	main()
@@ -1,10 +1,9 @@
 """Gunicorn configuration file."""
 
-import json
 import multiprocessing
 
+from quicksell.categories import populate_defaults
 from quicksell.database import Database
-from quicksell.models import Category
 
 bind = '0.0.0.0:8000'
 backlog = 2048
@@ -18,8 +17,6 @@ accesslog = '-'
 
 def on_starting(_):
 	Database.connect()
-	Database.migrate()
-	with Database.start_session():
-		if not Database.session.query(Category).first():
-			with open('assets/categories.json', 'r', encoding='utf-8') as f:
-				Category.populate(json.loads(f.read()))
+	# unchanged schema isn't reflected, `python -m quicksell migrate` forces it
+	if Database.migrate_if_changed():
+		populate_defaults()
@@ -0,0 +1,50 @@
+"""Management commands: python -m quicksell <command>."""
+
+import argparse
+import sys
+from datetime import datetime, timezone
+
+from quicksell.categories import populate_defaults
+from quicksell.database import Database
+
+
+def migrate(_):
+	Database.migrate()
+	populate_defaults()
+
+
+def check(_):
+	"""Exit with 1 if the declared schema wasn't applied."""
+	applied = Database.applied_fingerprint()
+	declared = Database.fingerprint()
+	print(f"Applied schema {applied}, declared {declared}")
+	if applied != declared:
+		sys.exit(1)
+
+
+def detach_partitions(arguments):
+	"""Detach partitions of rows before the month, print their names."""
+	month = datetime.strptime(arguments.month, '%Y-%m')
+	before = int(month.replace(tzinfo=timezone.utc).timestamp())
+	for partition in Database.detach_partitions(arguments.table, before):
+		print(partition)  # to archive and drop them
+
+
+parser = argparse.ArgumentParser(prog='python -m quicksell')
+commands = parser.add_subparsers(required=True, dest='command')
+commands.add_parser(
+	'migrate', help="compare the database with models and apply changes"
+).set_defaults(handler=migrate)
+commands.add_parser(
+	'check', help="exit with 1 if migration is needed"
+).set_defaults(handler=check)
+detach = commands.add_parser(
+	'detach-partitions', help="detach partitions of rows before the month"
+)
+detach.add_argument('table', choices=sorted(Database.partitioned))
+detach.add_argument('month', help="YYYY-MM")
+detach.set_defaults(handler=detach_partitions)
+
+arguments = parser.parse_args()
+Database.connect()
+arguments.handler(arguments)
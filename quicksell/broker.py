@@ -0,0 +1,136 @@
+"""PostgreSQL LISTEN/NOTIFY broker."""
+
+import asyncio
+import logging
+from collections import defaultdict
+from os import environ
+
+import asyncpg
+from sqlalchemy.sql import func, select
+
+from quicksell.database import Database
+
+
+class Broker:
+	"""Delivers notifications of PostgreSQL channels to subscribed handlers.
+
+	Each worker listens on a dedicated connection. Notifications of each
+	channel are queued and handled one by one, in the order of commits.
+	Notifications sent while the connection was lost can't be recovered,
+	so after reconnecting every handler is called with None payload to
+	resynchronize its state.
+	"""
+
+	HEARTBEAT = 10  # seconds between connection checks
+
+	def __init__(self):
+		self.handlers = defaultdict(list)
+		self.queues = {}  # payloads by channel
+		self.workers = set()
+		self.connection = None
+		self.task = None
+
+	def subscribe(self, channel: str, handler):
+		"""Call coroutine `handler(payload)` on each notification of `channel`."""
+		self.handlers[channel].append(handler)
+
+	@staticmethod
+	async def publish(channel: str, payload: str):
+		"""Notify the channel when the current session commits."""
+		await Database.session.execute(select(func.pg_notify(channel, payload)))
+
+	async def connect(self):
+		self.connection = await asyncpg.connect(
+			Database.URI, **Database.ASYNC_CONNECT_ARGS
+		)
+		for channel in self.handlers:
+			await self.connection.add_listener(channel, self.receive)
+
+	def receive(self, _connection, _pid, channel: str, payload: str):
+		if queue := self.queues.get(channel):
+			queue.put_nowait(payload)
+
+	async def work(self, channel: str):
+		queue = self.queues[channel]
+		while True:
+			payload = await queue.get()
+			for handler in self.handlers[channel]:
+				await self.handle(handler, payload)
+
+	@staticmethod
+	async def handle(handler, payload):
+		try:
+			await handler(payload)
+		except Exception:  # pylint: disable=broad-except
+			logging.exception("Notification handler failed")
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.HEARTBEAT)
+			try:
+				if not self.connection.is_closed():
+					await self.connection.execute('SELECT 1')
+					continue
+				await self.connect()
+			except (
+				OSError, asyncio.TimeoutError,
+				asyncpg.PostgresError, asyncpg.InterfaceError
+			):
+				logging.exception("Notifications connection failed")
+				self.connection.terminate()
+				continue
+			logging.info("Notifications connection restored")
+			for channel in self.queues:
+				self.receive(None, None, channel, None)
+
+	def start_workers(self):
+		for channel in self.handlers:
+			self.queues[channel] = asyncio.Queue()
+			self.workers.add(asyncio.create_task(self.work(channel)))
+
+	async def stop_workers(self):
+		for worker in self.workers:
+			worker.cancel()
+		await asyncio.gather(*self.workers, return_exceptions=True)
+		self.workers.clear()
+		self.queues.clear()
+
+	async def start(self):
+		self.start_workers()
+		await self.connect()
+		self.task = asyncio.create_task(self.run())
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			self.task = None
+		if self.connection:
+			await self.connection.close()
+			self.connection = None
+		await self.stop_workers()
+
+
+class LocalBroker(Broker):
+	"""In-process stand-in, for tests and single worker development.
+
+	Published notifications are delivered at once, ones of database
+	triggers aren't received.
+	"""
+
+	async def publish(self, channel, payload):
+		self.receive(None, None, channel, payload)
+
+	async def start(self):
+		self.start_workers()
+
+	async def stop(self):
+		await self.stop_workers()
+
+
+def default_broker() -> Broker:
+	if environ.get('BROKER', 'postgres') == 'local':
+		return LocalBroker()
+	return Broker()
+
+
+broker = default_broker()
@@ -0,0 +1,175 @@
+"""Caches."""
+
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from time import monotonic, time
+
+import orjson
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import delete, select
+
+from quicksell import metrics
+from quicksell.broker import broker
+from quicksell.database import Database
+from quicksell.models import CachedResponse
+
+
+class TTLCache:
+	"""Size bounded LRU cache with expiring entries."""
+
+	def __init__(self, maxsize: int, ttl: float):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.data = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.data)
+
+	def get(self, key, default=None):
+		item = self.data.get(key)
+		if item is None or item[0] < monotonic():
+			if item is not None:
+				del self.data[key]
+			self.misses += 1
+			return default
+		self.data.move_to_end(key)
+		self.hits += 1
+		return item[1]
+
+	def set(self, key, value, ttl: float = None):
+		self.data[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+		self.data.move_to_end(key)
+		while len(self.data) > self.maxsize:
+			self.data.popitem(last=False)
+
+	def pop(self, key):
+		self.data.pop(key, None)
+
+	def clear(self):
+		self.data.clear()
+
+
+class IdentityCache(TTLCache):
+	"""Authenticated identities by access token.
+
+	Evictions are broadcast to every worker, so rotated tokens stop
+	authenticating everywhere once the rotation is committed.
+	"""
+
+	CHANNEL = 'identity_evicted'
+
+	async def evict(self, token: str):
+		self.pop(token)
+		await broker.publish(self.CHANNEL, token)
+
+	async def receive(self, token: str):
+		if token is None:  # evictions were lost while reconnecting
+			self.clear()
+		else:
+			self.pop(token)
+
+	def start(self):
+		broker.subscribe(self.CHANNEL, self.receive)
+
+
+class ResponseCache:
+	"""Serialized responses shared by workers.
+
+	Each worker keeps recent responses in memory and falls back to
+	the unlogged CachedResponse table, filled by any of the workers.
+	"""
+
+	PURGE_INTERVAL = 60  # seconds
+	MAX_ROWS = 100000
+
+	def __init__(self, name: str, maxsize: int, ttl: int):
+		self.name = name
+		self.ttl = ttl
+		self.local = TTLCache(maxsize, ttl)
+		self.shared_hits = 0
+		self.task = None
+		metrics.gauge(f'{name}.local_hits', lambda: self.local.hits)
+		metrics.gauge(f'{name}.shared_hits', lambda: self.shared_hits)
+		metrics.gauge(
+			f'{name}.misses', lambda: self.local.misses - self.shared_hits
+		)
+		metrics.gauge(f'{name}.size', lambda: len(self.local))
+
+	def key(self, **params) -> str:
+		"""Cache key of normalized request parameters."""
+		params = orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+		return f'{self.name}:{hashlib.sha1(params).hexdigest()}'
+
+	async def get(self, key: str) -> tuple[bytes, dict]:
+		"""Body and headers of the cached response or None."""
+		if cached := self.local.get(key):
+			return cached
+		row = (await Database.session.execute(
+			select(
+				CachedResponse.body, CachedResponse.headers,
+				CachedResponse.ts_expires
+			)
+			.where(CachedResponse.key == key, CachedResponse.ts_expires > time())
+		)).first()
+		if not row:
+			return None
+		self.shared_hits += 1
+		cached = bytes(row.body), row.headers
+		self.local.set(key, cached, ttl=row.ts_expires - time())
+		return cached
+
+	async def set(self, key: str, body: bytes, headers: dict):
+		self.local.set(key, (body, headers))
+		values = {
+			'body': body,
+			'headers': headers,
+			'ts_expires': int(time()) + self.ttl
+		}
+		await Database.session.execute(
+			insert(CachedResponse)
+			.values(key=key, **values)
+			.on_conflict_do_update(index_elements=['key'], set_=values)
+		)
+
+	@staticmethod
+	async def purge():
+		await Database.session.execute(
+			delete(CachedResponse)
+			.where(CachedResponse.ts_expires <= time())
+			.execution_options(synchronize_session=False)
+		)
+		await Database.session.execute(
+			delete(CachedResponse)
+			.where(CachedResponse.id.in_(
+				select(CachedResponse.id)
+				.order_by(CachedResponse.ts_expires.desc())
+				.offset(ResponseCache.MAX_ROWS)
+			))
+			.execution_options(synchronize_session=False)
+		)
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.PURGE_INTERVAL)
+			try:
+				async with Database.start_async_session():
+					await self.purge()
+			except Exception:  # pylint: disable=broad-except
+				logging.exception("Failed to purge %s cache", self.name)
+
+	def start(self):
+		self.task = asyncio.create_task(self.run())
+
+	def stop(self):
+		if self.task:
+			self.task.cancel()
+			self.task = None
+
+
+identities = IdentityCache(maxsize=10000, ttl=60)
+# anonymous listing searches, same for all users until publication delay
+listings_cache = ResponseCache('listings_cache', maxsize=1000, ttl=30)
@@ -0,0 +1,87 @@
+"""Listing categories registry."""
+
+import asyncio
+import hashlib
+import json
+from collections import defaultdict
+
+import orjson
+
+from quicksell.broker import broker
+from quicksell.database import Database
+from quicksell.models import Category
+
+DEFAULTS_FILE = 'assets/categories.json'
+
+
+class CategoryRegistry:
+	"""Copy of the categories table in worker's memory.
+
+	Loaded on startup and reloaded in every worker when the table changes
+	and its trigger notifies Category.CHANNEL.
+	Categories are detached from any session, merge them to use in one.
+	"""
+
+	def __init__(self):
+		self.by_name = {}
+		self.descendants = {}
+		self.tree_json = b'{}'
+		self.version = None
+		self.lock = asyncio.Lock()
+
+	def get(self, name: str) -> Category:
+		return self.by_name.get(name)
+
+	def descendant_ids(self, names: list[str]) -> set[int]:
+		"""Ids of the categories and all their subcategories."""
+		ids = set()
+		for name in names:
+			if category := self.by_name.get(name):
+				ids.update(self.descendants[category.id])
+		return ids
+
+	async def load(self, _payload: str = None):
+		async with self.lock:
+			async with Database.start_async_session():
+				categories = await Category.select()
+			self.build(sorted(categories, key=lambda category: category.id))
+
+	def build(self, categories: list[Category]):
+		children = defaultdict(list)
+		for category in categories:
+			children[category.parent_id].append(category)
+
+		descendants = {}
+
+		def branch(parent: Category) -> dict:
+			subtree, ids = {}, {parent.id}
+			for child in children[parent.id]:
+				subtree[child.name] = branch(child)
+				ids.update(descendants[child.id])
+			descendants[parent.id] = frozenset(ids)
+			return subtree
+
+		tree = {category.name: branch(category) for category in children[None]}
+		tree_json = orjson.dumps(tree)
+		# swapped at once, requests never see a half built registry
+		self.by_name, self.descendants, self.tree_json, self.version = (
+			{category.name: category for category in categories},
+			descendants,
+			tree_json,
+			hashlib.sha1(tree_json).hexdigest()
+		)
+
+	async def start(self):
+		broker.subscribe(Category.CHANNEL, self.load)
+		await self.load()
+
+
+def populate_defaults():
+	"""Fill empty categories table with the default tree."""
+	with Database.start_session():
+		if not Database.session.query(Category).first():
+			with open(DEFAULTS_FILE, 'r', encoding='utf-8') as f:
+				Category.populate(json.loads(f.read()))
+
+
+categories = CategoryRegistry()
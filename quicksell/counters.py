@@ -0,0 +1,106 @@
+"""Buffered listing views counter."""
+
+import asyncio
+import logging
+from collections import Counter
+from contextlib import suppress
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import column, select, update, values
+from sqlalchemy.types import Integer, String
+
+from quicksell.database import Database
+from quicksell.models import Listing, View
+
+
+class ViewCounter:
+	"""Collects unique (listing, ip) views in memory and writes them in bulk.
+
+	Each flush inserts the batch into View skipping already known pairs and
+	increments Listing.views by the number of rows actually inserted. Rows
+	of listings are locked in the order of ids, so that concurrent flushes
+	of other workers wait for each other instead of deadlocking.
+	"""
+
+	FLUSH_INTERVAL = 10  # seconds
+	BATCH_SIZE = 5000  # rows per INSERT, keeps bind parameters under the limit
+	MAX_PENDING = 100000
+
+	def __init__(self):
+		self.pending = set()
+		self.task = None
+
+	def add(self, listing_id: int, ip: str):
+		if len(self.pending) < self.MAX_PENDING:
+			self.pending.add((listing_id, ip))
+
+	async def flush(self):
+		views, self.pending = sorted(self.pending), set()
+		for start in range(0, len(views), self.BATCH_SIZE):
+			batch = views[start:start + self.BATCH_SIZE]
+			try:
+				async with Database.start_async_session():
+					await self.write(batch)
+			except asyncio.CancelledError:
+				self.pending.update(views[start:])  # flushed on stop
+				raise
+			except Exception:  # pylint: disable=broad-except
+				logging.exception("Failed to save %d listing views", len(batch))
+
+	@staticmethod
+	async def write(views: list):
+		"""Insert views of existing listings, count the new ones."""
+		batch = values(
+			column('listing_id', Integer), column('ip', String), name='batch'
+		).data(views)
+		inserted = await Database.session.execute(
+			insert(View)
+			.from_select(
+				['listing_id', 'ip'],
+				select(batch.c.listing_id, batch.c.ip)
+				.join(Listing, Listing.id == batch.c.listing_id)
+				.order_by(Listing.id)
+				# deleted meanwhile would fail the foreign key of the batch
+				.with_for_update(of=Listing, read=True, key_share=True)
+			)
+			.on_conflict_do_nothing()
+			.returning(View.listing_id)
+		)
+		counts = sorted(Counter(inserted.scalars()).items())
+		if not counts:
+			return
+		await Database.session.execute(  # UPDATE locks rows in no given order
+			select(Listing.id)
+			.where(Listing.id.in_([listing_id for listing_id, _ in counts]))
+			.order_by(Listing.id)
+			.with_for_update(key_share=True)
+		)
+		increments = values(
+			column('listing_id', Integer), column('count', Integer),
+			name='increments'
+		).data(counts)
+		await Database.session.execute(
+			update(Listing)
+			.where(Listing.id == increments.c.listing_id)
+			.values(views=Listing.views + increments.c.count)
+			.execution_options(synchronize_session=False)
+		)
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.FLUSH_INTERVAL)
+			await self.flush()
+
+	def start(self):
+		self.task = asyncio.create_task(self.run())
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			with suppress(asyncio.CancelledError):
+				await self.task  # returns views of an interrupted flush
+			self.task = None
+		await self.flush()
+
+
+view_counter = ViewCounter()
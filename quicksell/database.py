@@ -1,17 +1,24 @@
 """Database manager."""
 
+import hashlib
 import logging
-from contextlib import contextmanager
+import re
+from contextlib import asynccontextmanager, contextmanager
 from contextvars import ContextVar
+from inspect import isawaitable
 from os import environ
 
 from alembic.autogenerate import produce_migrations
 from alembic.migration import MigrationContext
 from alembic.operations import Operations, ops
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.engine import create_engine
 from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import Session, sessionmaker
-from sqlalchemy.schema import MetaData
+from sqlalchemy.schema import CreateIndex, CreateTable, Index, MetaData
+from sqlalchemy.types import Enum
+from sqlalchemy.sql import text
 
 session_context = ContextVar('session')
 
@@ -41,15 +48,23 @@ class Database:
 	"""Database connection manager."""
 
 	CONNECT_ARGS = {'connect_timeout': 60}
+	ASYNC_CONNECT_ARGS = {'timeout': 60}
 	URI = 'postgresql://{user}:{password}@{host}:5432/{host}'.format(
 		user=environ['POSTGRES_USER'],
 		password=environ['POSTGRES_PASSWORD'],
 		host=environ['POSTGRES_DB'],
 	)
+	ASYNC_URI = URI.replace('postgresql://', 'postgresql+asyncpg://', 1)
 
 	engine = None
+	async_engine = None
 	session = SessionGetter()
 	metadata = MetaData()
+	extensions = set()  # PostgreSQL extensions required by models
+	routines = []  # idempotent DDL (functions, triggers) run on each migration
+	preparations = []  # idempotent DDL run before tables are created
+	partitioned = {}  # months of partitions made ahead by table name
+	VERSION_TABLE = 'SchemaVersion'  # fingerprints of applied schemas
 
 	@staticmethod
 	def connect():
@@ -65,6 +80,44 @@ class Database:
 			Database.engine, class_=RetryingSession, autoflush=False, future=True
 		)
 
+	@staticmethod
+	async def connect_async():
+		Database.async_engine = create_async_engine(
+			Database.ASYNC_URI, connect_args=Database.ASYNC_CONNECT_ARGS,
+			pool_pre_ping=True
+		)
+		try:
+			async with Database.async_engine.connect():
+				pass
+		except OperationalError as e:
+			raise TimeoutError("Database connection failed") from e
+		# sync_session_class keeps retries for everything AsyncSession executes,
+		# including lazy loads and flushes run in its greenlet
+		Database.async_sessionmaker = sessionmaker(
+			Database.async_engine, class_=AsyncSession,
+			sync_session_class=RetryingSession,
+			autoflush=False, expire_on_commit=False
+		)
+
+	@staticmethod
+	async def disconnect_async():
+		if Database.async_engine:
+			await Database.async_engine.dispose()
+			Database.async_engine = None
+
+	@staticmethod
+	def is_async() -> bool:
+		return isinstance(session_context.get(None), AsyncSession)
+
+	@staticmethod
+	def result(execution, handler):
+		"""Apply handler to execution result, awaiting it in async mode."""
+		if isawaitable(execution):
+			async def handle_async():
+				return handler(await execution)
+			return handle_async()
+		return handler(execution)
+
 	@staticmethod
 	@contextmanager
 	def start_session():
@@ -82,27 +135,263 @@ class Database:
 			session_context.reset(token)
 
 	@staticmethod
-	def migrate():
-		logging.info("Checking migrations...")
+	@asynccontextmanager
+	async def start_async_session():
+		if not Database.async_engine:
+			await Database.connect_async()
+		session = Database.async_sessionmaker()
+		token = session_context.set(session)
+		try:
+			yield
+			try:
+				await session.commit()
+			except SQLAlchemyError:
+				await session.rollback()
+		finally:
+			await session.close()
+			session_context.reset(token)
+
+	@staticmethod
+	def fingerprint() -> str:
+		"""Hash of the declared schema: tables, indexes, routines."""
 		# pylint: disable=import-outside-toplevel, unused-import
 		import quicksell.models  # required to fill metadata
+		dialect = postgresql.dialect()
+		ddl = [f'EXTENSION {name}' for name in sorted(Database.extensions)]
+		for table in Database.metadata.sorted_tables:
+			ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+			ddl.extend(
+				str(CreateIndex(index).compile(dialect=dialect))
+				for index in sorted(table.indexes, key=lambda index: index.name)
+			)
+			ddl.extend(  # values aren't in the DDL of the table
+				f'ENUM {column.type.name} {column.type.enums}'
+				for column in table.columns if isinstance(column.type, Enum)
+			)
+		ddl.extend(Database.preparations + Database.routines)
+		return hashlib.sha256('\n'.join(ddl).encode()).hexdigest()
+
+	@staticmethod
+	def applied_fingerprint() -> str:
+		with Database.engine.connect() as connection:
+			table = f'"{Database.VERSION_TABLE}"'
+			if connection.execute(
+				text("SELECT to_regclass(:table)"), {'table': table}
+			).scalar() is None:
+				return None
+			return connection.execute(text(
+				f"SELECT fingerprint FROM {table} ORDER BY id DESC LIMIT 1"
+			)).scalar()
+
+	@staticmethod
+	def migrate_if_changed() -> bool:
+		"""Migrate unless the declared schema was applied, return if it was.
+
+		Skips reflecting the database, so starting up takes no longer with
+		more tables.
+		"""
+		if Database.applied_fingerprint() == Database.fingerprint():
+			logging.info("Schema is up to date")
+			return False
+		Database.migrate()
+		return True
+
+	@staticmethod
+	def declared_indexes() -> dict[str, Index]:
+		return {
+			index.name: index
+			for table in Database.metadata.sorted_tables for index in table.indexes
+		}
+
+	@staticmethod
+	def index_ddl(
+		index: Index, name: str = None, table: str = None, only: bool = False,
+		concurrently: bool = True
+	) -> str:
+		"""CREATE INDEX CONCURRENTLY statement, of another name if given.
+
+		Of a partition if `table` is given, `only` makes a partitioned
+		table's index which isn't built on partitions, not concurrently.
+		"""
+		dialect = postgresql.dialect()
+		quote = dialect.identifier_preparer.quote
+		ddl = str(CreateIndex(index).compile(dialect=dialect))
+		declared = f' INDEX {quote(index.name)} ON {quote(index.table.name)} '
+		name = quote(name or index.name)
+		if only:
+			statement = f' INDEX {name} ON ONLY {quote(index.table.name)} '
+		else:
+			table = quote(table or index.table.name)
+			concurrently = 'CONCURRENTLY ' if concurrently else ''
+			statement = f' INDEX {concurrently}{name} ON {table} '
+		return ddl.replace(declared, statement, 1)
+
+	@staticmethod
+	def partitions(connection, table: str) -> list[tuple[str, str]]:
+		"""Names and bounds, like "FOR VALUES FROM (x) TO (y)"."""
+		return connection.execute(text("""
+			SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+			FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+			WHERE i.inhparent = to_regclass(:table)
+			ORDER BY c.relname
+		"""), {'table': f'"{table}"'}).all()
+
+	@staticmethod
+	def migrate_indexes():
+		"""Build missing and changed indexes without locking tables for writes.
+
+		Each index is commented with the hash of its declaration, an index
+		declared differently, e.g. made partial or covering, is replaced by
+		a new one. Indexes without the comment, made with their tables or
+		before the comments, are compared by definition once. Invalid indexes
+		left by failed builds are built again.
+		"""
+		def execute(statement: str):
+			connection.exec_driver_sql(statement)  # DDL isn't parsed for binds
+
+		def build(index: Index, name: str, digest: str):
+			logging.info("Building index %s...", index.name)
+			table = index.table.name
+			if table not in Database.partitioned:
+				execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+				execute(Database.index_ddl(index, name))
+			else:  # partitioned tables' indexes can't be built concurrently
+				execute(f'DROP INDEX IF EXISTS "{name}"')
+				execute(Database.index_ddl(index, name, only=True))
+				for partition, _ in Database.partitions(connection, table):
+					child = (
+						name.replace(table, partition, 1) if table in name
+						else f'{partition}_{name}'
+					)[:63]
+					execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{child}"')
+					execute(Database.index_ddl(index, child, table=partition))
+					execute(f'ALTER INDEX "{name}" ATTACH PARTITION "{child}"')
+			execute(f"COMMENT ON INDEX \"{name}\" IS '{digest}'")
+
+		def definition(index: Index) -> str:
+			"""pg_get_indexdef of the declaration, made on an empty copy."""
+			table = f'declared_{index.table.name}'[:63]
+			execute(f'DROP TABLE IF EXISTS pg_temp."{table}"')
+			execute(f'CREATE TEMP TABLE "{table}" (LIKE "{index.table.name}")')
+			execute(Database.index_ddl(index, table=table, concurrently=False))
+			declared = connection.execute(text("""
+				SELECT pg_get_indexdef(indexrelid) FROM pg_index
+				WHERE indrelid = to_regclass(:table)
+			"""), {'table': f'pg_temp."{table}"'}).scalar()
+			execute(f'DROP TABLE pg_temp."{table}"')
+			return declared
+
+		def same(existing: str, declared: str) -> bool:
+			"""Whether definitions differ by names of the index and table only."""
+			def shape(definition: str) -> tuple:
+				return (
+					definition.startswith('CREATE UNIQUE'),
+					definition.split(' USING ', 1)[1]
+				)
+			return shape(existing) == shape(declared)
+
+		def drop(name: str, table: str):
+			concurrently = '' if table in Database.partitioned else 'CONCURRENTLY'
+			execute(f'DROP INDEX {concurrently} "{name}"')
+
+		# outside of transactions, as concurrent builds require
+		with Database.engine.connect().execution_options(
+			isolation_level='AUTOCOMMIT'
+		) as connection:
+			existing = {row.name: row for row in connection.execute(text("""
+				SELECT
+					c.relname AS name, i.indisvalid AS valid,
+					obj_description(c.oid, 'pg_class') AS digest,
+					pg_get_indexdef(c.oid) AS definition
+				FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+				WHERE c.relnamespace = current_schema()::regnamespace
+			"""))}
+			for name, index in sorted(Database.declared_indexes().items()):
+				ddl = str(CreateIndex(index).compile(dialect=postgresql.dialect()))
+				digest = hashlib.sha1(ddl.encode()).hexdigest()
+				row = existing.get(name)
+				if row is None or not row.valid:
+					build(index, name, digest)
+				elif row.digest is None and same(row.definition, definition(index)):
+					execute(f"COMMENT ON INDEX \"{name}\" IS '{digest}'")
+				elif row.digest != digest:
+					build(index, f'{name[:50]}_rebuilt', digest)
+					drop(name, index.table.name)
+					execute(f'ALTER INDEX "{name[:50]}_rebuilt" RENAME TO "{name}"')
+
+	@staticmethod
+	def is_declared(name: str, type_: str, _parents) -> bool:
+		"""Whether autogenerate compares the table, not partitions."""
+		return type_ != 'table' or name != Database.VERSION_TABLE and not any(
+			name.startswith(f'{table}_') for table in Database.partitioned
+		)
+
+	@staticmethod
+	def detach_partitions(table: str, before: int) -> list[str]:
+		"""Detach partitions of rows before the time, for archiving."""
+		detached = []
+		with Database.engine.begin() as connection:
+			for partition, bound in Database.partitions(connection, table):
+				upper = re.search(r"TO \('?(\d+)'?\)", bound)
+				if upper and int(upper.group(1)) <= before:
+					connection.execute(text(
+						f'ALTER TABLE "{table}" DETACH PARTITION "{partition}"'
+					))
+					detached.append(partition)
+		return detached
+
+	@staticmethod
+	def migrate():
+		"""Compare the database with the declared schema and apply changes."""
+		logging.info("Checking migrations...")
+		fingerprint = Database.fingerprint()
+		with Database.engine.begin() as connection:
+			for extension in sorted(Database.extensions):
+				connection.execute(text(f"CREATE EXTENSION IF NOT EXISTS {extension}"))
+			for preparation in Database.preparations:
+				connection.execute(text(preparation))
 		Database.metadata.create_all(bind=Database.engine)
-		context = MigrationContext.configure(Database.engine.connect())
+		context = MigrationContext.configure(
+			Database.engine.connect(), opts={'include_name': Database.is_declared}
+		)
 		migrations = produce_migrations(context, Database.metadata)
 		if migrations.upgrade_ops.is_empty():
 			logging.info("No migrations detected")
-			return
-		logging.info("Migrating database...")
-		operations = Operations(context)
-		stack = [migrations.upgrade_ops]
-		with context.begin_transaction():
-			while stack:
-				op = stack.pop(0)
-				if isinstance(op, ops.DropTableOp):
-					logging.warning("Tables should be dropped manually")
-					continue
-				if isinstance(op, ops.OpContainer):
-					stack.extend(op.ops)
-				else:
-					operations.invoke(op)
-		logging.info("Migrations done")
+		else:
+			logging.info("Migrating database...")
+			operations = Operations(context)
+			stack = [migrations.upgrade_ops]
+			declared = Database.declared_indexes()
+			with context.begin_transaction():
+				while stack:
+					op = stack.pop(0)
+					if isinstance(op, ops.DropTableOp):
+						logging.warning("Tables should be dropped manually")
+						continue
+					if isinstance(op, ops.CreateIndexOp) or (
+						isinstance(op, ops.DropIndexOp) and op.index_name in declared
+					):
+						continue  # built concurrently by migrate_indexes
+					if isinstance(op, ops.OpContainer):
+						stack.extend(op.ops)
+					else:
+						operations.invoke(op)
+			logging.info("Migrations done")
+		Database.migrate_indexes()
+		with Database.engine.begin() as connection:
+			for routine in Database.routines:
+				connection.execute(text(routine))
+			connection.execute(text(f'''
+				CREATE TABLE IF NOT EXISTS "{Database.VERSION_TABLE}" (
+					id serial PRIMARY KEY,
+					fingerprint text NOT NULL,
+					ts_applied bigint NOT NULL DEFAULT extract(epoch FROM now())
+				)
+			'''))
+			connection.execute(
+				text(
+					f'INSERT INTO "{Database.VERSION_TABLE}" (fingerprint) '
+					'VALUES (:fingerprint)'
+				),
+				{'fingerprint': fingerprint}
+			)
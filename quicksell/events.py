@@ -0,0 +1,135 @@
+"""Real-time events of users, delivered over WebSockets."""
+
+import asyncio
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+
+import orjson
+from starlette.status import WS_1008_POLICY_VIOLATION, WS_1013_TRY_AGAIN_LATER
+
+from quicksell import metrics
+from quicksell.broker import broker
+from quicksell.cache import IdentityCache
+from quicksell.database import Database
+from quicksell.models import Inbox, Message, User
+from quicksell.schemas import ChatRetrieve, MessageRetrieve
+from quicksell.serializers import schema_serializer
+
+EVENT_SCHEMAS = {
+	'chat': (Inbox, ChatRetrieve),  # the creator's row
+	'message': (Message, MessageRetrieve),
+}
+
+
+class EventHub:
+	"""Queues of events of the users connected to this worker.
+
+	Events are published with NOTIFY in the publishing transaction, so every
+	worker receives them after commit and queues them for its connections.
+	Payloads over the NOTIFY limit are sent as references, loaded by the
+	workers having connections of the users. Connections are closed when
+	their access token is evicted and no longer identifies the user.
+	"""
+
+	CHANNEL = 'user_events'
+	MAX_PAYLOAD = 7900  # bytes, NOTIFY limit is 8000
+	QUEUE_SIZE = 100  # events per connection
+	RESYNC = orjson.dumps({'event': 'resync'}).decode()  # events were lost
+
+	def __init__(self):
+		self.queues = defaultdict(set)  # by user id
+		self.tokens = defaultdict(set)  # queues by access token
+		metrics.gauge(
+			'events.connections', lambda: sum(map(len, self.queues.values()))
+		)
+
+	@contextmanager
+	def connect(self, user_id: int, token: str) -> asyncio.Queue:
+		"""Queue of the user's events, JSON encoded, ended by a close code."""
+		queue = asyncio.Queue(self.QUEUE_SIZE)
+		self.queues[user_id].add(queue)
+		self.tokens[token].add(queue)
+		try:
+			yield queue
+		finally:
+			for queues, key in ((self.queues, user_id), (self.tokens, token)):
+				queues[key].discard(queue)
+				if not queues[key]:
+					del queues[key]
+
+	@staticmethod
+	async def publish(user_ids: list[int], event: str, obj=None, **extra):
+		"""Send `obj` by the event's schema to the users after commit.
+
+		`extra` JSON values are sent along, e.g. the chat of a message.
+		"""
+		message = {'users': list(user_ids), 'event': event, **extra}
+		if obj is not None:
+			message['data'] = schema_serializer(EVENT_SCHEMAS[event][1])(obj)
+		payload = orjson.dumps(message)
+		if len(payload) > EventHub.MAX_PAYLOAD and obj is not None:
+			del message['data']
+			message['id'] = obj.id
+			payload = orjson.dumps(message)
+		await broker.publish(EventHub.CHANNEL, payload.decode())
+
+	async def receive(self, payload: str):
+		if payload is None:  # broker reconnected
+			self.put(self.queues, self.RESYNC)
+			return
+		message = orjson.loads(payload)
+		user_ids = [
+			user_id for user_id in message.pop('users') if user_id in self.queues
+		]
+		if not user_ids:
+			return
+		if 'id' in message:
+			data = await self.load(message['event'], message.pop('id'))
+			if data is None:  # deleted meanwhile
+				return
+			message['data'] = data
+		self.put(user_ids, orjson.dumps(message).decode())
+
+	@staticmethod
+	async def load(event: str, obj_id: int) -> dict:
+		model, schema = EVENT_SCHEMAS[event]
+		async with Database.start_async_session():
+			obj = await model.scalar(model.id == obj_id, options=schema.options())
+		return obj and schema_serializer(schema)(obj)
+
+	def put(self, user_ids, text: str):
+		for user_id in list(user_ids):
+			for queue in self.queues.get(user_id, ()):
+				try:
+					queue.put_nowait(text)
+				except asyncio.QueueFull:
+					logging.warning("Events of user %d overflowed", user_id)
+					self.close(queue, WS_1013_TRY_AGAIN_LATER)
+
+	@staticmethod
+	def close(queue: asyncio.Queue, code: int):
+		while not queue.empty():
+			queue.get_nowait()
+		queue.put_nowait(code)
+
+	async def revoke(self, token: str):
+		"""Close connections of the evicted token unless it's still valid."""
+		tokens = list(self.tokens) if token is None else [token]  # all if lost
+		tokens = [token for token in tokens if token in self.tokens]
+		if not tokens:
+			return
+		async with Database.start_async_session():
+			revoked = [
+				token for token in tokens if not await User.identify(token)
+			]
+		for token in revoked:
+			for queue in self.tokens.get(token, ()):
+				self.close(queue, WS_1008_POLICY_VIOLATION)
+
+	def start(self):
+		broker.subscribe(self.CHANNEL, self.receive)
+		broker.subscribe(IdentityCache.CHANNEL, self.revoke)
+
+
+events = EventHub()
@@ -56,3 +56,36 @@ class Conflict(HTTPException):
 			detail or "Resource already exists",
 			headers
 		)
+
+
+class PayloadTooLarge(HTTPException):
+	"""413"""
+
+	def __init__(self, detail: str = None, headers: dict = None):
+		super().__init__(
+			status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+			detail or "Request is too large",
+			headers
+		)
+
+
+class RangeNotSatisfiable(HTTPException):
+	"""416"""
+
+	def __init__(self, detail: str = None, headers: dict = None):
+		super().__init__(
+			status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+			detail or "Requested range is not satisfiable",
+			headers
+		)
+
+
+class ServiceUnavailable(HTTPException):
+	"""503"""
+
+	def __init__(self, detail: str = None, headers: dict = None):
+		super().__init__(
+			status.HTTP_503_SERVICE_UNAVAILABLE,
+			detail or "Service is temporarily overloaded",
+			headers or {"Retry-After": "1"}
+		)
@@ -0,0 +1,40 @@
+"""Image variants, made in worker processes.
+
+Imports nothing from the app, so the process pool starts quickly.
+"""
+
+from PIL import Image, ImageOps
+
+# larger images raise DecompressionBombError
+Image.MAX_IMAGE_PIXELS = 50_000_000
+
+THUMBNAIL_SIZE = (400, 400)
+THUMBNAIL_QUALITY = 80
+WEBP_MAX_SIZE = (1600, 1600)
+WEBP_QUALITY = 80
+
+
+def variant_names(filename: str) -> dict[str, str]:
+	"""Filenames of the photo's variants by variant name."""
+	stem = filename.rsplit('.', 1)[0]
+	return {'thumbnail': f'{stem}.thumb.jpg', 'webp': f'{stem}.webp'}
+
+
+def make_variants(source: str, targets: dict[str, str]):
+	"""Save fixed size JPEG thumbnail and compressed WebP of the photo.
+
+	`targets` are paths of the variants by variant name.
+	"""
+	with Image.open(source) as original:
+		original.draft('RGB', WEBP_MAX_SIZE)  # JPEG is decoded downscaled
+		image = ImageOps.exif_transpose(original)
+	image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+	thumbnail = ImageOps.fit(image.convert('RGB'), THUMBNAIL_SIZE)
+	thumbnail.save(
+		targets['thumbnail'], format='JPEG',
+		quality=THUMBNAIL_QUALITY, optimize=True, progressive=True
+	)
+
+	image.thumbnail(WEBP_MAX_SIZE)
+	image.save(targets['webp'], format='WEBP', quality=WEBP_QUALITY, method=4)
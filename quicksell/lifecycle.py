@@ -0,0 +1,79 @@
+"""Listing state transitions by time."""
+
+import asyncio
+import logging
+from time import time
+
+from sqlalchemy.sql import select, update
+
+from quicksell import metrics
+from quicksell.database import Database
+from quicksell.models import Listing, Profile
+from quicksell.notifications import dispatcher
+
+
+class ListingScheduler:
+	"""Closes expired listings and notifies their sellers.
+
+	Batches of expired rows are locked skipping ones locked by other
+	workers or requests, so workers close different rows and requests
+	aren't waited for.
+	"""
+
+	INTERVAL = 60  # seconds
+	BATCH_SIZE = 500
+
+	def __init__(self):
+		self.task = None
+		self.expired = 0
+		metrics.gauge('listings.expired', lambda: self.expired)
+
+	async def expire(self) -> int:
+		"""Close a batch of expired listings, return their number."""
+		expired = (
+			select(Listing.id)
+			.where(Listing.active(), Listing.ts_expires <= int(time()))
+			.limit(self.BATCH_SIZE)
+			.with_for_update(skip_locked=True)
+		)
+		async with Database.start_async_session():
+			rows = (await Database.session.execute(
+				update(Listing)
+				.where(Listing.id.in_(expired))
+				.values(state=Listing.State.closed)
+				.returning(Listing.uuid, Listing.title, Listing.seller_id)
+				.execution_options(synchronize_session=False)
+			)).all()
+			sellers = dict((await Database.session.execute(
+				select(Profile.id, Profile.user_id)
+				.where(Profile.id.in_({row.seller_id for row in rows}))
+			)).all()) if rows else {}
+			# failures propagate, start_async_session would swallow them
+			await Database.session.commit()
+		for row in rows:
+			dispatcher.push(
+				[sellers[row.seller_id]], "Listing expired", row.title,
+				{'type': 'listing_expired', 'listing': row.uuid.hex}
+			)
+		self.expired += len(rows)
+		return len(rows)
+
+	async def run(self):
+		while True:
+			try:
+				while await self.expire() == self.BATCH_SIZE:
+					pass
+			except Exception:  # pylint: disable=broad-except
+				logging.exception("Failed to expire listings")
+			await asyncio.sleep(self.INTERVAL)
+
+	def start(self):
+		self.task = asyncio.create_task(self.run())
+
+	def stop(self):
+		if self.task:
+			self.task.cancel()
+			self.task = None
+
+
+listing_scheduler = ListingScheduler()
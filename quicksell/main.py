@@ -1,14 +1,30 @@
 """App main."""
 
+from hmac import compare_digest
 from os import environ
 
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
+from fastapi import Depends, FastAPI
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
+from quicksell import metrics
+from quicksell.broker import broker
+from quicksell.cache import identities, listings_cache
+from quicksell.categories import categories
+from quicksell.counters import view_counter
+from quicksell.database import Database
+from quicksell.events import events
+from quicksell.exceptions import NotFound
+from quicksell.lifecycle import listing_scheduler
+from quicksell.media import image_pipeline, media_collector
+from quicksell.notifications import dispatcher
+from quicksell.partitions import partition_keeper
 from quicksell.routes import (
-	chats_router, listings_router, offers_router, shops_router, users_router
+	chats_router, events_router, listings_router, media_router, offers_router,
+	shops_router, users_router
 )
 
+METRICS_TOKEN = environ.get('METRICS_TOKEN')
+
 app = FastAPI(
 	title="Quickell API",
 	version='0.8.1',
@@ -19,14 +35,62 @@ app = FastAPI(
 )
 
 app.include_router(chats_router)
+app.include_router(events_router)
 app.include_router(listings_router)
+app.include_router(media_router)
 app.include_router(offers_router)
 app.include_router(shops_router)
 app.include_router(users_router)
 
-app.mount('/media', StaticFiles(directory='media'), name='media')
+
+@app.on_event('startup')
+async def startup():
+	await Database.connect_async()
+	await categories.start()
+	identities.start()  # subscribes before the broker connects
+	events.start()
+	await broker.start()
+	view_counter.start()
+	dispatcher.start()
+	listings_cache.start()
+	image_pipeline.start()
+	media_collector.start()
+	listing_scheduler.start()
+	partition_keeper.start()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+	listings_cache.stop()
+	media_collector.stop()
+	listing_scheduler.stop()
+	partition_keeper.stop()
+	await image_pipeline.stop()
+	await view_counter.stop()
+	await dispatcher.stop()
+	await broker.stop()
+	await Database.disconnect_async()
 
 
 @app.get('/', tags=['Info'])
 async def main():
 	return f"{app.title} {app.version}"
+
+
+async def metrics_access(
+	credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(
+		auto_error=False
+	))
+):
+	"""Bearer METRICS_TOKEN, metrics aren't served without the variable."""
+	if not METRICS_TOKEN or not credentials or not compare_digest(
+		credentials.credentials.encode(), METRICS_TOKEN.encode()
+	):
+		raise NotFound()
+
+
+@app.get(
+	'/metrics/', include_in_schema=False, dependencies=[Depends(metrics_access)]
+)
+async def worker_metrics():
+	return metrics.report()
@@ -0,0 +1,422 @@
+"""Uploaded media files."""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from os import environ
+from time import time
+from uuid import uuid4
+
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import delete, select, update
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from quicksell import metrics
+from quicksell.database import Database
+from quicksell.exceptions import BadRequest, PayloadTooLarge
+from quicksell.images import make_variants, variant_names
+from quicksell.models import Listing, MediaFile
+from quicksell.models.base import sql_ts_now
+from quicksell.storage import MEDIA_DIR, content_key, storage
+
+UPLOAD_DIR = os.path.join(MEDIA_DIR, '.uploads')  # same filesystem for rename
+
+MAX_PHOTO_SIZE = 10 * 1024 * 1024
+MAX_PHOTOS = 10  # per request
+WRITE_SIZE = 256 * 1024  # bytes buffered before writing to disk
+
+PHOTO_SIGNATURES = {
+	b'\xff\xd8\xff': 'jpg',
+	b'\x89PNG\r\n\x1a\n': 'png',
+}
+SIGNATURE_SIZE = max(map(len, PHOTO_SIGNATURES))
+
+UPLOAD_SCHEMA = {'requestBody': {'required': True, 'content': {
+	'multipart/form-data': {'schema': {
+		'type': 'object',
+		'properties': {'files': {
+			'type': 'array', 'items': {'type': 'string', 'format': 'binary'}
+		}}
+	}}
+}}}
+
+
+def photo_extension(head: bytes) -> str:
+	for signature, extension in PHOTO_SIGNATURES.items():
+		if head.startswith(signature):
+			return extension
+	return None
+
+
+def with_variants(keys: list[str]) -> list[str]:
+	return [
+		name for key in keys for name in (key, *variant_names(key).values())
+	]
+
+
+async def register(key: str):
+	"""Record stored file, committed at once so it's never left untracked.
+
+	Its update time is renewed, so the garbage collector waits for it to
+	be referenced, and it waits for the collector deleting the file, so
+	the file is stored again.
+	"""
+	async with Database.start_async_session():
+		await Database.session.execute(
+			insert(MediaFile)
+			.values(key=key)
+			.on_conflict_do_update(
+				index_elements=['key'], set_={'ts_update': sql_ts_now}
+			)
+		)
+
+
+class PhotoUpload:
+	"""Photo written to a temporary file until it's published.
+
+	At most WRITE_SIZE bytes are kept in memory, file operations and
+	hashing run in the thread pool.
+	"""
+
+	def __init__(self):
+		self.path = os.path.join(UPLOAD_DIR, uuid4().hex)
+		self.file = None
+		self.hash = hashlib.sha256()
+		self.buffer = bytearray()
+		self.size = 0
+		self.extension = None
+
+	async def write(self, data: bytes):
+		self.size += len(data)
+		if self.size > MAX_PHOTO_SIZE:
+			raise PayloadTooLarge(f"Photo is larger than {MAX_PHOTO_SIZE} bytes")
+		self.buffer += data
+		if self.extension is None and len(self.buffer) >= SIGNATURE_SIZE:
+			self.check_type()
+		if len(self.buffer) >= WRITE_SIZE:
+			await self.flush()
+
+	def check_type(self):
+		self.extension = photo_extension(bytes(self.buffer[:SIGNATURE_SIZE]))
+		if not self.extension:
+			raise BadRequest("Wrong file type")
+
+	async def flush(self):
+		data, self.buffer = self.buffer, bytearray()
+		await run_in_threadpool(self.write_block, data)
+
+	def write_block(self, data: bytearray):
+		if self.file is None:
+			self.file = open(self.path, 'xb')  # pylint: disable=consider-using-with
+		self.hash.update(data)
+		self.file.write(data)
+
+	async def close(self):
+		if self.extension is None:
+			self.check_type()
+		await self.flush()
+		await run_in_threadpool(self.sync)
+
+	def sync(self):
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.file.close()
+
+	async def publish(self) -> str:
+		"""Move complete file to the storage unless it's there, return its key."""
+		key = content_key(self.hash.hexdigest(), self.extension)
+		await register(key)
+		if await storage.exists(key):
+			await run_in_threadpool(self.discard)
+		else:
+			await storage.save(self.path, key)
+		return key
+
+	def discard(self):
+		if self.file:
+			self.file.close()
+		try:
+			os.remove(self.path)
+		except FileNotFoundError:
+			pass
+
+
+class PhotosReceiver:
+	"""Streams file parts of a multipart request to temporary files.
+
+	Parser callbacks only collect events, writes happen between chunks.
+	"""
+
+	def __init__(self, boundary: bytes):
+		self.parser = MultipartParser(boundary, {
+			'on_part_begin': self.on_part_begin,
+			'on_header_field': self.on_header_field,
+			'on_header_value': self.on_header_value,
+			'on_header_end': self.on_header_end,
+			'on_headers_finished': self.on_headers_finished,
+			'on_part_data': self.on_part_data,
+			'on_part_end': self.on_part_end,
+		})
+		self.events = []
+		self.headers = {}
+		self.header_field = self.header_value = b''
+		self.photo = None
+		self.photos = []
+
+	def on_part_begin(self):
+		self.headers = {}
+
+	def on_header_field(self, data: bytes, start: int, end: int):
+		self.header_field += data[start:end]
+
+	def on_header_value(self, data: bytes, start: int, end: int):
+		self.header_value += data[start:end]
+
+	def on_header_end(self):
+		self.headers[self.header_field.lower()] = self.header_value
+		self.header_field = self.header_value = b''
+
+	def on_headers_finished(self):
+		_, options = parse_options_header(
+			self.headers.get(b'content-disposition', b'')
+		)
+		self.events.append(('begin', b'filename' in options))
+
+	def on_part_data(self, data: bytes, start: int, end: int):
+		self.events.append(('data', data[start:end]))
+
+	def on_part_end(self):
+		self.events.append(('end', None))
+
+	async def process(self):
+		events, self.events = self.events, []
+		for event, value in events:
+			if event == 'begin':
+				self.photo = None
+				if value:  # other form fields are ignored
+					if len(self.photos) == MAX_PHOTOS:
+						raise BadRequest(f"No more than {MAX_PHOTOS} photos at once")
+					self.photo = PhotoUpload()
+					self.photos.append(self.photo)
+			elif self.photo is None:
+				continue
+			elif event == 'data':
+				await self.photo.write(value)
+			else:
+				await self.photo.close()
+				self.photo = None
+
+	async def receive(self, request: Request) -> list[str]:
+		published = []
+		try:
+			async for chunk in request.stream():
+				self.parser.write(chunk)
+				await self.process()
+			self.parser.finalize()
+			await self.process()
+			if not self.photos or self.photo:
+				raise BadRequest("No complete photos received")
+			for photo in self.photos:
+				published.append(await photo.publish())
+		except MultipartParseError as e:
+			raise BadRequest("Malformed multipart form") from e
+		finally:
+			if len(published) < len(self.photos):
+				# published files are unreferenced, so garbage collected
+				await run_in_threadpool(self.discard)
+		return published
+
+	def discard(self):
+		for photo in self.photos:
+			photo.discard()
+
+
+async def receive_photos(request: Request) -> list[str]:
+	"""Save photos of a multipart request, return their keys."""
+	content_type, options = parse_options_header(
+		request.headers.get('Content-Type', '')
+	)
+	if content_type != b'multipart/form-data' or b'boundary' not in options:
+		raise BadRequest("Multipart form expected")
+	size = request.headers.get('Content-Length', '0')
+	if size.isdigit() and int(size) > MAX_PHOTOS * MAX_PHOTO_SIZE:
+		raise PayloadTooLarge()
+	return await PhotosReceiver(options[b'boundary']).receive(request)
+
+
+class ImagePipeline:
+	"""Makes variants of uploaded photos in a process pool.
+
+	Variants are stored by the photo's key, so they are made once for equal
+	photos, and recorded in Listing.photo_variants if the photo is still
+	in the listing when they are ready.
+	"""
+
+	WORKERS = int(environ.get('IMAGE_WORKERS', 2))  # processes per app worker
+	QUEUE_SIZE = 1000
+
+	def __init__(self):
+		self.executor = None
+		self.queue = None
+		self.tasks = []
+
+	def push(self, listing_id: int, keys: list[str]):
+		if self.queue is None:
+			return
+		for key in keys:
+			try:
+				self.queue.put_nowait((listing_id, key))
+			except asyncio.QueueFull:
+				logging.warning("Image queue is full, %s not processed", key)
+
+	async def work(self):
+		while True:
+			listing_id, key = await self.queue.get()
+			try:
+				await register(key)  # variants are collected with the photo
+				variants = variant_names(key)
+				if not all([await storage.exists(name) for name in variants.values()]):
+					await self.make_variants(key, variants)
+				async with Database.start_async_session():
+					await self.record(listing_id, key, variants)
+			except Exception:  # pylint: disable=broad-except
+				logging.exception("Failed to process %s", key)
+			finally:
+				self.queue.task_done()
+
+	async def make_variants(self, key: str, variants: dict[str, str]):
+		targets = {
+			variant: os.path.join(UPLOAD_DIR, uuid4().hex) for variant in variants
+		}
+		try:
+			async with storage.local_copy(key) as source:
+				await asyncio.get_running_loop().run_in_executor(
+					self.executor, make_variants, source, targets
+				)
+			for variant, path in targets.items():
+				await storage.save(path, variants[variant])
+		finally:
+			await run_in_threadpool(remove_temporary, list(targets.values()))
+
+	@staticmethod
+	async def record(listing_id: int, key: str, variants: dict):
+		await Database.session.execute(
+			update(Listing)
+			.where(Listing.id == listing_id, Listing.photos.any(key))
+			.values(photo_variants=Listing.photo_variants.op('||')({key: variants}))
+			.execution_options(synchronize_session=False)
+		)
+
+	def start(self):
+		# spawned processes don't inherit the event loop and connections
+		self.executor = ProcessPoolExecutor(
+			self.WORKERS, mp_context=multiprocessing.get_context('spawn')
+		)
+		self.queue = asyncio.Queue(self.QUEUE_SIZE)
+		self.tasks = [
+			asyncio.create_task(self.work()) for _ in range(self.WORKERS)
+		]
+
+	async def stop(self, timeout=30):
+		if self.queue is not None:
+			try:
+				await asyncio.wait_for(self.queue.join(), timeout)
+			except asyncio.TimeoutError:
+				logging.warning("%d photos not processed", self.queue.qsize())
+		for task in self.tasks:
+			task.cancel()
+		self.tasks = []
+		if self.executor:
+			self.executor.shutdown(wait=False, cancel_futures=True)
+			self.executor = None
+
+
+def remove_temporary(paths: list[str]):
+	for path in paths:
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+
+
+class MediaCollector:
+	"""Deletes files no committed row references, with their variants.
+
+	A file is collected once its reference count has been zero for the
+	grace period, so uploads have time to be referenced, and rolled back
+	changes leave no files behind. Workers lock batches of rows, skipping
+	ones locked by others, and delete the rows after the files, so rows of
+	failed deletions are collected again.
+	"""
+
+	INTERVAL = 600  # seconds
+	GRACE = int(environ.get('MEDIA_GC_GRACE', 24 * 3600))  # seconds
+	BATCH_SIZE = 500
+
+	def __init__(self):
+		self.task = None
+		self.collected = 0
+		metrics.gauge('media_gc.collected', lambda: self.collected)
+
+	async def collect(self) -> int:
+		"""Delete a batch of files, return their number."""
+		async with Database.start_async_session():
+			keys = (await Database.session.execute(
+				select(MediaFile.key)
+				.where(
+					MediaFile.refs <= 0,
+					MediaFile.ts_update < int(time()) - self.GRACE
+				)
+				.limit(self.BATCH_SIZE)
+				.with_for_update(skip_locked=True)
+			)).scalars().all()
+			if keys:
+				await storage.delete(with_variants(keys))
+				await Database.session.execute(
+					delete(MediaFile)
+					.where(MediaFile.key.in_(keys))
+					.execution_options(synchronize_session=False)
+				)
+		self.collected += len(keys)
+		return len(keys)
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.INTERVAL)
+			try:
+				while await self.collect() == self.BATCH_SIZE:
+					pass
+				await run_in_threadpool(remove_stale_uploads, self.GRACE)
+			except Exception:  # pylint: disable=broad-except
+				logging.exception("Failed to collect media files")
+
+	def start(self):
+		self.task = asyncio.create_task(self.run())
+
+	def stop(self):
+		if self.task:
+			self.task.cancel()
+			self.task = None
+
+
+def remove_stale_uploads(age: int):
+	"""Temporary files left by killed workers."""
+	with os.scandir(UPLOAD_DIR) as entries:
+		paths = [
+			entry.path for entry in entries
+			if entry.stat().st_mtime < time() - age
+		]
+	remove_temporary(paths)
+
+
+image_pipeline = ImagePipeline()
+media_collector = MediaCollector()
+
+
+os.makedirs(UPLOAD_DIR, exist_ok=True)
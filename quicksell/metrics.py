@@ -0,0 +1,51 @@
+"""Metrics of the worker process."""
+
+from typing import Callable
+
+
+class Timer:
+	"""Count, total and maximum duration of an operation."""
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def observe(self, seconds: float):
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+
+	def report(self) -> dict:
+		return {
+			'count': self.count,
+			'total': round(self.total, 6),
+			'avg': round(self.total / self.count, 6) if self.count else 0,
+			'max': round(self.max, 6),
+		}
+
+
+class Gauge:
+	"""Current value read from a callable."""
+
+	def __init__(self, getter: Callable):
+		self.getter = getter
+
+	def report(self):
+		return self.getter()
+
+
+registry = {}
+
+
+def timer(name: str) -> Timer:
+	return registry.setdefault(name, Timer())
+
+
+def gauge(name: str, getter: Callable) -> Gauge:
+	registry[name] = Gauge(getter)
+	return registry[name]
+
+
+def report() -> dict:
+	return {name: metric.report() for name, metric in sorted(registry.items())}
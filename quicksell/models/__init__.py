@@ -1,8 +1,10 @@
 """Database models."""
 
-from .base import Model, UniqueViolation
-from .chat import Chat, Message
+from .base import InvalidCursor, Model, Page, UniqueViolation
+from .cache import CachedResponse
+from .chat import Chat, Inbox, Message
 from .listing import Category, Listing, View
+from .media import MediaFile
 from .offer import Offer
 from .shop import Company, Shop
 from .user import Device, Profile, User
@@ -1,21 +1,24 @@
 """Base class of database models."""
 
-import math
+import enum
 from functools import partial
 from uuid import uuid4
 
 from psycopg2.errorcodes import UNIQUE_VIOLATION
+from sqlalchemy import event
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB, UUID
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import as_declarative
 from sqlalchemy.ext.mutable import MutableDict, MutableList
 from sqlalchemy.orm import declared_attr, relationship
-from sqlalchemy.schema import Column, ForeignKey, Table
-from sqlalchemy.sql import func, select
+from sqlalchemy.schema import Column, ForeignKey, Index, Table
+from sqlalchemy.sql import and_, func, select, tuple_
 from sqlalchemy.types import BigInteger, Float, Integer, String
 
 from quicksell.database import Database
 
+Database.extensions.update(('cube', 'earthdistance'))
+
 sql_ts_now = func.extract('epoch', func.now())
 ColumnUUID = partial(
 	Column, UUID(as_uuid=True), nullable=False, default=uuid4, index=True
@@ -31,16 +34,72 @@ ColumnJSON = partial(
 class UniqueViolation(Exception):
 	"""PostgreSQL unique constraint violation error."""
 
-	def __init__(self, pg_exception_details):
+	def __init__(self, message_detail, table_name):
 		super().__init__()
-		key, value = pg_exception_details.message_detail.split(')=(')
+		key, value = message_detail.split(')=(')
 		self.value = value[:value.find(')')]
 		self.column = key[key.find('(') + 1:]
-		self.table = pg_exception_details.table_name
+		self.table = table_name
 
 	def __str__(self):
 		return f"{self.table} with {self.column} '{self.value}' already exists"
 
+	@classmethod
+	def from_error(cls, error: IntegrityError):
+		if diag := getattr(error.orig, 'diag', None):  # psycopg2
+			return cls(diag.message_detail, diag.table_name)
+		details = error.orig.__cause__  # asyncpg
+		return cls(details.detail, details.table_name)
+
+
+class InvalidCursor(ValueError):
+	"""Pagination key of another ordering or not of the sort column's type."""
+
+
+def cursor_value(column_type, value):
+	"""Value of the column type decoded from JSON, as the database takes it."""
+	if value is None:
+		return None
+	try:
+		python_type = column_type.python_type
+	except NotImplementedError:  # expressions, e.g. ranks
+		python_type = type(value) if type(value) in (int, float) else None
+	if isinstance(python_type, type) and issubclass(python_type, enum.Enum):
+		if isinstance(value, str) and value in python_type.__members__:
+			return python_type[value]
+	elif python_type is int:
+		bits = 63 if isinstance(column_type, BigInteger) else 31
+		if type(value) is int and -2 ** bits <= value < 2 ** bits:
+			return value
+	elif python_type is float:
+		if type(value) in (int, float):
+			return float(value)
+	elif python_type is bool:
+		if type(value) is bool:
+			return value
+	elif python_type is str:
+		if type(value) is str and '\x00' not in value:
+			return value
+	raise InvalidCursor()
+
+
+def sortable(column_type) -> bool:
+	"""Whether values of the column type make cursors, see cursor_value."""
+	try:
+		python_type = column_type.python_type
+	except NotImplementedError:
+		return False
+	return python_type in (int, float, str, bool) \
+		or issubclass(python_type, enum.Enum)
+
+
+class Page(list):
+	"""Paginated rows with the sort key of the next page."""
+
+	def __init__(self, rows, next_key: tuple = None):  # see Model.paginate
+		super().__init__(rows)
+		self.next_key = next_key
+
 
 @as_declarative(metadata=Database.metadata)
 class Model:
@@ -55,44 +114,143 @@ class Model:
 	ts_spawn = Column(BigInteger, server_default=sql_ts_now, index=True)
 
 	def save(self):
+		if Database.is_async():
+			return self.save_async()
 		try:
 			Database.session.add(self)
 			Database.session.flush()
 		except IntegrityError as e:
 			Database.session.rollback()
 			if e.orig.pgcode == UNIQUE_VIOLATION:
-				raise UniqueViolation(e.orig.diag) from e
+				raise UniqueViolation.from_error(e) from e
 			raise
 		return self
 
+	async def save_async(self, reload_options=None):
+		try:
+			Database.session.add(self)
+			await Database.session.flush()
+		except IntegrityError as e:
+			await Database.session.rollback()
+			if e.orig.pgcode == UNIQUE_VIOLATION:
+				raise UniqueViolation.from_error(e) from e
+			raise
+		if reload_options is not None:
+			# server defaults and relationships of a new row can't be
+			# lazy loaded later outside of the session's greenlet
+			await Database.session.execute(
+				select(type(self)).where(type(self).id == self.id)
+				.options(*reload_options)
+				.execution_options(populate_existing=True)
+			)
+		return self
+
 	@classmethod
-	def insert(cls, *args, **kwargs):
+	def insert(cls, *args, options=(), **kwargs):
+		if Database.is_async():
+			return cls(*args, **kwargs).save_async(reload_options=options)
 		return cls(*args, **kwargs).save()
 
 	@classmethod
-	def select(cls, *filters):
-		return Database.session.execute(
-			select(cls).where(*filters)
-		).scalars().unique().all()
+	def select(cls, *filters, options=()):
+		return Database.result(
+			Database.session.execute(select(cls).where(*filters).options(*options)),
+			lambda result: result.scalars().unique().all()
+		)
+
+	@classmethod
+	def scalar(cls, *filters, options=()):
+		return Database.result(
+			Database.session.execute(select(cls).where(*filters).options(*options)),
+			lambda result: result.scalar()
+		)
 
 	@classmethod
-	def scalar(cls, *filters):
-		return Database.session.execute(select(cls).where(*filters)).scalar()
+	def ordering(cls, order_by: str = None, columns=()):
+		"""Parse order_by like '-ts_spawn' into name, expression and direction.
+
+		Besides table columns of scalar types it may name one of the labeled
+		`columns`. Anything else is ordered by id.
+		"""
+		if order_by:
+			name = order_by.removeprefix('-')
+			labels = {label.name: label.element for label in columns}
+			column = labels.get(name, cls.__table__.columns.get(name))
+			if name in labels or column is not None and sortable(column.type):
+				return name, column, order_by.startswith('-')
+		return 'id', cls.__table__.c.id, False
 
 	@classmethod
-	def paginate(cls, *filters, order_by=None, page=0):
-		query = select(cls).where(*filters) \
-			.offset(page * cls.PAGE_SIZE).limit(cls.PAGE_SIZE)
-		if order_by is not None:
-			if isinstance(order_by, str):
-				order_col = cls.__table__.columns.get(order_by.removeprefix('-'))
-				if order_col is not None:
-					if order_by.startswith('-'):
-						order_col = order_col.desc()
-					query = query.order_by(order_col)
+	def page_query(
+		cls, *filters, order_by=None, page=0, after=None, columns=(), options=()
+	):
+		"""Query of a page, offset by page number or following the `after` key.
+
+		The key is (ordering, sort column value, id) of the last row of the
+		previous page, tie-broken by id so it is unique and pages are stable
+		under inserts. Keys of another ordering or with values not of the
+		columns' types raise InvalidCursor. NULLs are sorted as the greatest
+		values, as PostgreSQL does by default, so indexes still serve both
+		directions.
+		"""
+		name, column, descending = cls.ordering(order_by, columns)
+		ordering = '-' + name if descending else name
+		sort_key = tuple_(column, cls.id)
+		query = select(cls, *columns).where(*filters).options(*options) \
+			.limit(cls.PAGE_SIZE)
+		if after is not None:
+			key_ordering, value, row_id = after
+			if key_ordering != ordering or row_id is None:
+				raise InvalidCursor()
+			value = cursor_value(column.type, value)
+			row_id = cursor_value(cls.__table__.c.id.type, row_id)
+			nullable = getattr(column, 'nullable', True)  # labels may be NULL
+			if value is None:  # among NULLs, after the values if descending
+				following = column.is_(None) & (
+					cls.id < row_id if descending else cls.id > row_id
+				)
+				if descending:
+					following |= column.isnot(None)
+			elif descending:
+				following = sort_key < (value, row_id)
 			else:
-				query = query.order_by(order_by)
-		return Database.session.execute(query).scalars().unique().all()
+				following = sort_key > (value, row_id)
+				if nullable:
+					following |= column.is_(None)
+			query = query.where(following)
+			if name in cls.__table__.c and value is not None \
+				and (descending or not nullable):
+				# row comparisons alone don't bound index scans or prune partitions
+				query = query.where(column <= value if descending else column >= value)
+		else:
+			query = query.offset(page * cls.PAGE_SIZE)
+		if descending:
+			return query.order_by(column.desc(), cls.id.desc())
+		return query.order_by(column, cls.id)
+
+	@classmethod
+	def paginate(cls, *filters, order_by=None, columns=(), **kwargs):
+		"""Page of rows of `page_query`, with the key of the next one.
+
+		Values of labeled `columns` are set as rows' attributes.
+		"""
+		query = cls.page_query(
+			*filters, order_by=order_by, columns=columns, **kwargs
+		)
+		name, _, descending = cls.ordering(order_by, columns)
+		ordering = '-' + name if descending else name
+
+		def to_page(result):
+			rows = []
+			for obj, *values in result.unique():
+				for label, value in zip(columns, values):
+					setattr(obj, label.name, value)
+				rows.append(obj)
+			if len(rows) < cls.PAGE_SIZE:
+				return Page(rows)
+			return Page(rows, (ordering, getattr(rows[-1], name), rows[-1].id))
+
+		return Database.result(Database.session.execute(query), to_page)
 
 	def update(self, **kwargs):
 		for attribute, value in kwargs.items():
@@ -100,7 +258,7 @@ class Model:
 		return self.save()
 
 	def delete(self):
-		Database.session.delete(self)
+		return Database.session.delete(self)
 
 
 class LocationMixin:
@@ -110,6 +268,8 @@ class LocationMixin:
 	longitude = Column(Float, index=True)
 	address = Column(String)
 
+	distance = None  # set by queries selecting `distance_to`
+
 	@property
 	def location(self):
 		if not self.address:
@@ -126,32 +286,40 @@ class LocationMixin:
 		self.longitude = location_dict['longitude']
 		self.address = location_dict['address']
 
-	# @classmethod
-	# def in_range(cls, latitude, longitude, radius):
-	# 	latitude = math.radians(latitude)
-	# 	longitude = math.radians(longitude)
-	# 	expression = (func.acos(
-	# 		func.sin(func.radians(cls.latitude)) * math.sin(latitude)
-	# 		+ func.cos(func.radians(cls.latitude)) * math.cos(latitude)
-	# 		* func.cos(func.radians(cls.longitude) - longitude)
-	# 	) * 6378137).label('distance')
-	# 	delta_lng = (180 / math.pi) * (radius / 6378137)
-	# 	delta_lat = delta_lng / math.cos(latitude)
-	# 	filt = (
-	# 		cls.longitude.between(cls.longitude - delta_lng, cls.longitude + delta_lng)
-	# 		& cls.latitude.between(cls.latitude - delta_lat, cls.latitude + delta_lat)
-	# 		& (expression <= radius)
-	# 	)
-	# 	return filt, expression
-
-	# @classmethod
-	# def ordered_by_distance(cls, lat, lng, radius, *filters, desc, page=1):
-	# 	range_filter, distance_expression = cls.in_range(lat, lng, radius)
-	# 	return Database.session.execute(
-	# 		select(cls, distance_expression).where(range_filter, *filters)
-	# 		.order_by(distance_expression.desc() if desc else distance_expression)
-	# 		.offset(page * cls.PAGE_SIZE).limit(cls.PAGE_SIZE)
-	# 	).scalars().unique().all()
+	@classmethod
+	def earth_point(cls):
+		return func.ll_to_earth(cls.latitude, cls.longitude)
+
+	@classmethod
+	def in_range(cls, latitude, longitude, radius):
+		"""Filter of objects within radius (meters) of the point."""
+		center = func.ll_to_earth(latitude, longitude)
+		return and_(
+			func.earth_box(center, radius).op('@>')(cls.earth_point()),
+			func.earth_distance(center, cls.earth_point()) <= radius
+		)
+
+	@classmethod
+	def distance_to(cls, latitude, longitude):
+		"""Distance (meters) to the point, served by the GiST index in ORDER BY.
+
+		It's the straight line distance through the Earth, which is within
+		a meter from the great-circle one for the first hundred kilometers.
+		"""
+		return cls.earth_point().op('<->', return_type=Float)(
+			func.ll_to_earth(latitude, longitude)
+		).label('distance')
+
+
+@event.listens_for(LocationMixin, 'instrument_class', propagate=True)
+def index_earth_point(mapper, cls):
+	"""GiST index of the location, for `in_range` and `distance_to`."""
+	columns = mapper.local_table.c
+	Index(
+		f'ix_{cls.__name__}_earth_point',
+		func.ll_to_earth(columns.latitude, columns.longitude),
+		postgresql_using='gist'
+	)
 
 
 def association(table_from, table_to, **kwargs):
@@ -183,3 +351,111 @@ def foreign_key(table_name, index=True, **kwargs):
 		ForeignKey(table_name + '.id', use_alter=True),
 		index=index, **kwargs
 	)
+
+
+def partition_by_month(table: str, months_ahead: int = 3):
+	"""Keep the table in monthly range partitions of ts_spawn.
+
+	The table must be declared with postgresql_partition_by. Partitions
+	are made ahead by migrations and create_month_partitions calls.
+	Existing plain table is converted: renamed, its primary key dropped
+	and, once the partitioned one is created, attached as the partition
+	of all rows until the next month, its key and indexes built then.
+	Its old indexes are dropped, but ones taken as the partition's.
+	"""
+	Database.partitioned[table] = months_ahead
+	legacy = f'{table}_legacy'
+	Database.preparations.append(f'''
+DO $$
+DECLARE
+	name text;
+BEGIN
+	IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('"{table}"')) = 'r'
+	THEN
+		ALTER TABLE "{table}" RENAME TO "{legacy}";
+		ALTER SEQUENCE IF EXISTS "{table}_id_seq" RENAME TO "{legacy}_id_seq";
+		FOR name IN SELECT indexname FROM pg_indexes
+			WHERE schemaname = current_schema() AND tablename = '{legacy}'
+		LOOP
+			EXECUTE format('ALTER INDEX %I RENAME TO %I', name, 'legacy_' || name);
+		END LOOP;
+		-- the partitioned table's key includes ts_spawn, it's made on
+		-- attaching; foreign keys to the old one are dropped with it
+		FOR name IN SELECT conname FROM pg_constraint
+			WHERE conrelid = '"{legacy}"'::regclass AND contype = 'p'
+		LOOP
+			EXECUTE format(
+				'ALTER TABLE %I DROP CONSTRAINT %I CASCADE', '{legacy}', name
+			);
+		END LOOP;
+		-- triggers of the partitioned table are cloned on attaching
+		FOR name IN SELECT tgname FROM pg_trigger
+			WHERE tgrelid = '"{legacy}"'::regclass AND NOT tgisinternal
+		LOOP
+			EXECUTE format('DROP TRIGGER %I ON %I', name, '{legacy}');
+		END LOOP;
+	END IF;
+END $$;
+''')
+	Database.routines.append(f'''
+DO $$
+DECLARE
+	name text;
+BEGIN
+	IF NOT (
+		SELECT relispartition FROM pg_class
+		WHERE oid = to_regclass('"{legacy}"')
+	) THEN
+		PERFORM setval(
+			pg_get_serial_sequence('"{table}"', 'id'),
+			(SELECT coalesce(max(id), 0) + 1 FROM "{legacy}"), false
+		);
+		UPDATE "{legacy}" SET ts_spawn = 0 WHERE ts_spawn IS NULL;
+		ALTER TABLE "{legacy}" ALTER COLUMN ts_spawn SET NOT NULL;
+		EXECUTE format(
+			'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (MINVALUE) TO (%s)',
+			'{table}', '{legacy}',
+			extract(epoch FROM date_trunc('month', now()) + interval '1 month')::bigint
+		);
+		-- matching indexes were attached to the partitioned table's ones
+		FOR name IN SELECT c.relname FROM pg_index i
+			JOIN pg_class c ON c.oid = i.indexrelid
+			WHERE i.indrelid = '"{legacy}"'::regclass AND NOT c.relispartition
+				AND NOT EXISTS (
+					SELECT FROM pg_constraint WHERE conindid = i.indexrelid
+				)
+		LOOP
+			EXECUTE format('DROP INDEX %I', name);
+		END LOOP;
+	END IF;
+END $$;
+
+SELECT create_month_partitions('{table}', {months_ahead});
+''')
+
+
+Database.routines.append('''
+CREATE OR REPLACE FUNCTION create_month_partitions(parent text, months int)
+RETURNS void AS $$
+DECLARE
+	month timestamptz;
+BEGIN
+	IF NOT pg_try_advisory_xact_lock(hashtext('create_month_partitions')) THEN
+		RETURN;  -- being made by another worker
+	END IF;
+	FOR i IN 0..months LOOP
+		month := date_trunc('month', now()) + i * interval '1 month';
+		BEGIN
+			EXECUTE format(
+				'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I
+				FOR VALUES FROM (%s) TO (%s)',
+				parent || to_char(month, '"_y"YYYY"m"MM'), parent,
+				extract(epoch FROM month)::bigint,
+				extract(epoch FROM month + interval '1 month')::bigint
+			);
+		EXCEPTION WHEN invalid_object_definition THEN
+			NULL;  -- overlaps the partition of rows from before partitioning
+		END;
+	END LOOP;
+END $$ LANGUAGE plpgsql;
+''')
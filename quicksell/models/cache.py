@@ -0,0 +1,18 @@
+"""Cache related database models."""
+
+from sqlalchemy.schema import Column
+from sqlalchemy.types import BigInteger, LargeBinary, String
+
+from .base import ColumnJSON, Model
+
+
+class CachedResponse(Model):
+	"""Serialized API response shared by all workers."""
+
+	# not WAL-logged: faster writes, emptied after a crash
+	__table_args__ = {'prefixes': ['UNLOGGED']}
+
+	key = Column(String, nullable=False, unique=True)
+	ts_expires = Column(BigInteger, nullable=False, index=True)
+	body = Column(LargeBinary, nullable=False)
+	headers = ColumnJSON()
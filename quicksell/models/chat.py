@@ -1,10 +1,15 @@
 """Chat and Message models."""
 
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relationship
-from sqlalchemy.schema import Column
-from sqlalchemy.types import BigInteger, String, Text
+from sqlalchemy.schema import Column, Index, UniqueConstraint
+from sqlalchemy.types import BigInteger, Integer, String, Text
 
-from .base import ColumnUUID, Model, association, foreign_key, sql_ts_now
+from quicksell.database import Database
+
+from .base import (
+	ColumnUUID, Model, association, foreign_key, partition_by_month, sql_ts_now
+)
 
 
 class Chat(Model):
@@ -14,18 +19,11 @@ class Chat(Model):
 
 	uuid = ColumnUUID()
 	listing_id = foreign_key('Listing', nullable=True, index=False)
-	last_message_id = foreign_key('Message', nullable=True, index=False)
 	subject = Column(String, nullable=False)
 	ts_update = Column(BigInteger, server_default=sql_ts_now, onupdate=sql_ts_now)
 
-	members = association('Chat', 'Profile', back_populates='chats', lazy=False)
-	listing = relationship('Listing', back_populates=None, lazy=False)
-	last_message = relationship(
-		'Message',
-		lazy=False,
-		post_update=True,
-		foreign_keys=[last_message_id],
-	)
+	members = association('Chat', 'Profile', back_populates='chats')
+	listing = relationship('Listing', back_populates=None)
 	messages = relationship(
 		'Message',
 		back_populates='chat',
@@ -35,17 +33,109 @@ class Chat(Model):
 	)
 
 	def allowed(self, user):
-		return user.profile in self.members
+		return any(member.id == user.profile_id for member in self.members)
 
 
 class Message(Model):
-	"""Message in Chat."""
+	"""Message in Chat.
+
+	Partitioned by month of ts_spawn, which is a part of the primary key,
+	so history of a chat is read from the partitions of the period only.
+	"""
+
+	__table_args__ = (
+		Index('ix_Message_chat_id_ts_spawn', 'chat_id', 'ts_spawn', 'id'),
+		{'postgresql_partition_by': 'RANGE (ts_spawn)'},
+	)
 
 	PAGE_SIZE = 40
 
+	id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+	ts_spawn = Column(BigInteger, primary_key=True, server_default=sql_ts_now)
 	author_id = foreign_key('Profile')
-	chat_id = foreign_key('Chat')
+	chat_id = foreign_key('Chat', index=False)
 	text = Column(Text)
 
 	chat = relationship('Chat', back_populates='messages', foreign_keys=[chat_id])
-	author = relationship('Profile', back_populates=None, lazy=False)
+	author = relationship('Profile', back_populates=None)
+
+
+class Inbox(Model):
+	"""Chat as listed to one of its members.
+
+	Rows are kept by triggers: added and removed with members, updated by
+	each message, so the member's chats are read by one index range scan.
+	"""
+
+	__table_args__ = (
+		UniqueConstraint('profile_id', 'chat_id'),
+		Index('ix_Inbox_profile_id_ts_update', 'profile_id', 'ts_update', 'id'),
+	)
+
+	PAGE_SIZE = 20
+
+	profile_id = foreign_key('Profile', nullable=False, index=False)
+	chat_id = foreign_key('Chat', nullable=False)
+	last_message_id = Column(Integer)  # no foreign key, messages are partitioned
+	ts_update = Column(BigInteger, nullable=False, server_default=sql_ts_now)
+	unread = Column(Integer, nullable=False, server_default='0')
+
+	chat = relationship('Chat', back_populates=None)
+	last_message = relationship(
+		'Message', primaryjoin='foreign(Inbox.last_message_id) == Message.id',
+		viewonly=True
+	)
+	uuid = association_proxy('chat', 'uuid')
+	subject = association_proxy('chat', 'subject')
+	members = association_proxy('chat', 'members')
+
+
+partition_by_month('Message')
+Database.routines.append('''
+CREATE OR REPLACE FUNCTION inbox_member() RETURNS trigger AS $$
+BEGIN
+	IF TG_OP = 'INSERT' THEN
+		INSERT INTO "Inbox" (profile_id, chat_id)
+		VALUES (NEW.profile_id, NEW.chat_id)
+		ON CONFLICT (profile_id, chat_id) DO NOTHING;
+	ELSE
+		DELETE FROM "Inbox"
+		WHERE profile_id = OLD.profile_id AND chat_id = OLD.chat_id;
+	END IF;
+	RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS inbox_member ON "AssociationChatProfile";
+CREATE TRIGGER inbox_member
+	AFTER INSERT OR DELETE ON "AssociationChatProfile"
+	FOR EACH ROW EXECUTE FUNCTION inbox_member();
+
+CREATE OR REPLACE FUNCTION inbox_message() RETURNS trigger AS $$
+BEGIN
+	UPDATE "Inbox" SET
+		last_message_id = NEW.id,
+		ts_update = NEW.ts_spawn,
+		unread = CASE WHEN profile_id = NEW.author_id THEN 0 ELSE unread + 1 END
+	WHERE chat_id = NEW.chat_id;
+	RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS inbox_message ON "Message";
+CREATE TRIGGER inbox_message
+	AFTER INSERT ON "Message"
+	FOR EACH ROW EXECUTE FUNCTION inbox_message();
+
+-- members of chats created before the inbox, skipped once added
+INSERT INTO "Inbox" (profile_id, chat_id, last_message_id, ts_update)
+SELECT
+	member.profile_id, member.chat_id, latest.id,
+	coalesce(latest.ts_spawn, chat.ts_update)
+FROM "AssociationChatProfile" member
+JOIN "Chat" chat ON chat.id = member.chat_id
+LEFT JOIN LATERAL (
+	SELECT id, ts_spawn FROM "Message"
+	WHERE chat_id = member.chat_id
+	ORDER BY ts_spawn DESC LIMIT 1
+) latest ON true
+ON CONFLICT (profile_id, chat_id) DO NOTHING;
+''')
@@ -1,13 +1,19 @@
 """Listings related database models."""
 
 import enum
+import re
 from datetime import timedelta
+from functools import partial
 
-from sqlalchemy import UniqueConstraint, event
-from sqlalchemy.orm import relationship
-from sqlalchemy.schema import Column
+from sqlalchemy import UniqueConstraint
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred, relationship
+from sqlalchemy.schema import Column, Index
+from sqlalchemy.sql import func, literal_column, or_
 from sqlalchemy.types import BigInteger, Boolean, Enum, Integer, String, Text
 
+from quicksell.database import Database
+
 from .base import (
 	ColumnArray, ColumnJSON, ColumnUUID, LocationMixin, Model, foreign_key,
 	sql_ts_now
@@ -15,11 +21,39 @@ from .base import (
 
 DEFAULT_LISTING_EXPIRY_TIME = timedelta(days=30).total_seconds()
 sql_ts_expires = sql_ts_now + DEFAULT_LISTING_EXPIRY_TIME
+SEARCH_CONFIG = 'russian'
+# of listed rows, the rest are neither searched nor expired
+IndexActive = partial(
+	Index, postgresql_where=literal_column("state = 'active'")
+)
 
 
 class Listing(Model, LocationMixin):
 	"""Listing model."""
 
+	__table_args__ = (
+		Index('ix_Listing_search_vector', 'search_vector', postgresql_using='gin'),
+		Index(
+			'ix_Listing_title_trgm', 'title', postgresql_using='gin',
+			postgresql_ops={'title': 'gin_trgm_ops'}
+		),
+		# for the search, see benchmarks/listing_plans.py; views aren't
+		# indexed so the counter's updates stay HOT
+		IndexActive('ix_Listing_active_ts_spawn', 'ts_spawn', 'id'),
+		IndexActive(
+			'ix_Listing_active_category_id_ts_spawn', 'category_id', 'ts_spawn', 'id'
+		),
+		IndexActive(
+			'ix_Listing_active_category_id_price', 'category_id', 'price', 'id'
+		),
+		IndexActive(
+			'ix_Listing_active_seller_id_ts_spawn', 'seller_id', 'ts_spawn', 'id'
+		),
+		IndexActive('ix_Listing_active_is_new_ts_spawn', 'is_new', 'ts_spawn', 'id'),
+		IndexActive('ix_Listing_active_price', 'price', 'id'),
+		IndexActive('ix_Listing_active_ts_expires', 'ts_expires'),  # to expire
+	)
+
 	PAGE_SIZE = 30
 	PUBLICATION_DELAY = timedelta(hours=5).total_seconds()
 
@@ -50,31 +84,62 @@ class Listing(Model, LocationMixin):
 	views = Column(Integer, nullable=False, default=0)
 
 	photos = ColumnArray()
+	photo_variants = ColumnJSON()  # {photo: {variant: filename}}, when ready
 
-	seller = relationship('Profile', lazy=False)
-	category = relationship('Category', lazy=False)
+	# maintained by trigger from title, category name and description
+	search_vector = deferred(Column(TSVECTOR))
+
+	seller = relationship('Profile')
+	category = relationship('Category')
 	offers = relationship(
 		'Offer',
 		back_populates='listing',
-		lazy=True,
 		cascade='all, delete-orphan'
 	)
 
 	def allowed(self, user):
-		return user.profile is self.seller
+		return self.seller_id == user.profile_id
+
+	@classmethod
+	def active(cls):
+		"""Condition of the partial indexes, literal to match generic plans."""
+		return cls.state == literal_column("'active'")
+
+	@staticmethod
+	def search_query(text):
+		return func.websearch_to_tsquery(
+			literal_column(f"'{SEARCH_CONFIG}'::regconfig"), text
+		)
+
+	@classmethod
+	def matches(cls, text):
+		"""Full-text match, substring or trigram similarity of the title."""
+		pattern = '%{}%'.format(re.sub(r'([%_\\])', r'\\\1', text))
+		return or_(
+			cls.search_vector.op('@@')(cls.search_query(text)),
+			cls.title.ilike(pattern),
+			cls.title.op('%')(text),
+		)
+
+	@classmethod
+	def relevance(cls, text):
+		return (
+			func.ts_rank_cd(cls.search_vector, cls.search_query(text))
+			+ func.similarity(cls.title, text)
+		).label('relevance')
 
 
 class Category(Model):
 	"""Listings category model."""
 
+	CHANNEL = 'category'  # notified on any change, see CategoryRegistry
+
 	name = Column(String, nullable=False, unique=True)
 	parent_id = foreign_key('Category')
 	assignable = Column(Boolean, nullable=False, default=False)
 
 	parent = relationship('Category', uselist=False)
 
-	cached_tree = None
-
 	@staticmethod
 	def populate(categories: dict, parent_id: int = None):
 		for name, subcategories in categories.items():
@@ -83,14 +148,6 @@ class Category(Model):
 			)
 			Category.populate(subcategories, category.id)
 
-	@staticmethod
-	def setup_events():
-		def clear_cache():
-			Category.cached_tree = None
-		event.listen(Category, 'after_insert', clear_cache)
-		event.listen(Category, 'after_update', clear_cache)
-		event.listen(Category, 'after_delete', clear_cache)
-
 
 class View(Model):
 	"""Listing view model."""
@@ -99,3 +156,50 @@ class View(Model):
 
 	listing_id = foreign_key('Listing', nullable=False)
 	ip = Column(String, nullable=False, index=True)
+
+
+Database.extensions.add('pg_trgm')
+Database.routines.append(f'''
+CREATE OR REPLACE FUNCTION listing_search_vector() RETURNS trigger AS $$
+BEGIN
+	NEW.search_vector :=
+		setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.title, '')), 'A')
+		|| setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(
+			(SELECT name FROM "Category" WHERE id = NEW.category_id), ''
+		)), 'B')
+		|| setweight(to_tsvector(
+			'{SEARCH_CONFIG}', coalesce(NEW.description, '')
+		), 'C');
+	RETURN NEW;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS listing_search_vector ON "Listing";
+CREATE TRIGGER listing_search_vector
+	BEFORE INSERT OR UPDATE OF title, description, category_id ON "Listing"
+	FOR EACH ROW EXECUTE FUNCTION listing_search_vector();
+
+CREATE OR REPLACE FUNCTION category_search_vector() RETURNS trigger AS $$
+BEGIN
+	UPDATE "Listing" SET title = title WHERE category_id = NEW.id;
+	RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS category_search_vector ON "Category";
+CREATE TRIGGER category_search_vector
+	AFTER UPDATE OF name ON "Category"
+	FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+	EXECUTE FUNCTION category_search_vector();
+
+CREATE OR REPLACE FUNCTION category_notify() RETURNS trigger AS $$
+BEGIN
+	PERFORM pg_notify('{Category.CHANNEL}', '');
+	RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS category_notify ON "Category";
+CREATE TRIGGER category_notify
+	AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "Category"
+	FOR EACH STATEMENT EXECUTE FUNCTION category_notify();
+
+UPDATE "Listing" SET title = title WHERE search_vector IS NULL;
+''')
@@ -0,0 +1,104 @@
+"""Media files database models."""
+
+from sqlalchemy.schema import Column
+from sqlalchemy.types import BigInteger, Integer, String
+
+from quicksell.database import Database
+
+from .base import Model, sql_ts_now
+
+
+class MediaFile(Model):
+	"""Stored file with the number of rows referencing it.
+
+	References are counted by triggers of the columns holding file keys,
+	see count_references.
+	"""
+
+	# content addressed keys like 'ab/cd/abcd...ef.jpg' and random names of
+	# files stored before them, other values of the columns, such as
+	# external URLs, are not counted
+	KEY_PATTERN = (
+		r'^([0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}|[0-9a-f]{32})\.[a-z0-9.]+$'
+	)
+	LEGACY_KEY_PATTERN = r'^[0-9a-f]{32}\.'
+
+	key = Column(String, nullable=False, unique=True)
+	refs = Column(Integer, nullable=False, default=0, server_default='0')
+	ts_update = Column(
+		BigInteger, server_default=sql_ts_now, onupdate=sql_ts_now, index=True
+	)
+
+
+references = []  # (table, column, array)
+
+
+def count_references(table: str, column: str, array: bool = False):
+	"""Keep MediaFile.refs of the keys in the column up to date."""
+	references.append((table, column, array))
+	old, new = f'OLD."{column}"', f'NEW."{column}"'
+	if not array:
+		old, new = f'ARRAY[{old}]', f'ARRAY[{new}]'
+	function = f'{table}_{column}_media_refs'
+	Database.routines.append(f'''
+CREATE OR REPLACE FUNCTION "{function}"() RETURNS trigger AS $$
+BEGIN
+	IF TG_OP = 'INSERT' THEN
+		PERFORM media_refs_change('{{}}', {new}::text[]);
+	ELSIF TG_OP = 'DELETE' THEN
+		PERFORM media_refs_change({old}::text[], '{{}}');
+	ELSE
+		PERFORM media_refs_change({old}::text[], {new}::text[]);
+	END IF;
+	RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS "{function}" ON "{table}";
+CREATE TRIGGER "{function}"
+	AFTER INSERT OR DELETE OR UPDATE OF "{column}" ON "{table}"
+	FOR EACH ROW EXECUTE FUNCTION "{function}"();
+''')
+
+
+Database.routines.append(f'''
+CREATE OR REPLACE FUNCTION media_refs_change(old_keys text[], new_keys text[])
+RETURNS void AS $$
+	INSERT INTO "MediaFile" AS file (key, refs)
+	SELECT key, sum(delta) FROM (
+		SELECT unnest(new_keys) AS key, 1 AS delta
+		UNION ALL
+		SELECT unnest(old_keys), -1
+	) AS changes
+	WHERE key ~ '{MediaFile.KEY_PATTERN}'
+	GROUP BY key
+	HAVING sum(delta) <> 0
+	ON CONFLICT (key) DO UPDATE
+	SET refs = file.refs + EXCLUDED.refs, ts_update = EXCLUDED.ts_update;
+$$ LANGUAGE sql;
+''')
+count_references('Listing', 'photos', array=True)
+count_references('Profile', 'avatar')
+count_references('Shop', 'photo')
+count_references('Company', 'logo')
+
+
+def seed_legacy_references():
+	"""Count references of files stored before the triggers.
+
+	Keys already counted are skipped, so it's run on each migration.
+	"""
+	keys = ' UNION ALL '.join(
+		f'SELECT unnest("{column}") FROM "{table}"' if array else
+		f'SELECT "{column}" FROM "{table}"'
+		for table, column, array in references
+	)
+	Database.routines.append(f'''
+INSERT INTO "MediaFile" (key, refs)
+SELECT key, count(*) FROM ({keys}) AS refs (key)
+WHERE key ~ '{MediaFile.LEGACY_KEY_PATTERN}'
+GROUP BY key
+ON CONFLICT (key) DO NOTHING;
+''')
+
+
+seed_legacy_references()
@@ -20,8 +20,8 @@ class Offer(Model):
 	accepted = Column(Boolean)
 	active = Column(Boolean, default=True)
 
-	listing = relationship('Listing', lazy='joined')
-	company = relationship('Company', lazy='joined')
+	listing = relationship('Listing')
+	company = relationship('Company')
 
 	def allowed(self, user):
-		return user.company is self.company
+		return self.company_id == user.company_id
@@ -12,6 +12,8 @@ from .base import ColumnUUID, LocationMixin, Model, foreign_key
 class Shop(Model, LocationMixin):
 	"""Shop model."""
 
+	PAGE_SIZE = 30
+
 	uuid = ColumnUUID()
 	company_id = foreign_key('Company')
 
@@ -20,7 +22,7 @@ class Shop(Model, LocationMixin):
 	phone = Column(String, nullable=False)
 	photo = Column(String)
 
-	company = relationship('Company', back_populates='shops', lazy=False)
+	company = relationship('Company', back_populates='shops')
 
 
 class Company(Model):
@@ -49,5 +51,5 @@ class Company(Model):
 	logo = Column(String)
 
 	owner = relationship('User', back_populates='company')
-	shops = relationship('Shop', back_populates='company', lazy=False)
-	offers = relationship('Offer', back_populates='company', lazy=False)
+	shops = relationship('Shop', back_populates='company')
+	offers = relationship('Offer', back_populates='company')
@@ -4,9 +4,13 @@ import enum
 
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import Column
+from sqlalchemy.sql import select
 from sqlalchemy.types import Boolean, Enum, Integer, SmallInteger, String
 
+from quicksell.database import Database
+
 from .base import ColumnUUID, LocationMixin, Model, association, foreign_key
+from .shop import Company
 
 
 class User(Model):
@@ -26,17 +30,27 @@ class User(Model):
 
 	balance = Column(Integer, nullable=False, default=0)
 
-	profile = relationship(
-		'Profile', back_populates='user', lazy=False, uselist=False
-	)
+	profile = relationship('Profile', back_populates='user', uselist=False)
 	device = relationship('Device', back_populates='owner', uselist=False)
 	company = relationship('Company', back_populates='owner', uselist=False)
 	favorites = association(
 		'User', 'Listing',
-		lazy=False,
 		order_by='desc(self.ts_spawn)'
 	)
 
+	@staticmethod
+	def identify(access_token: str):
+		"""Ids of the user, its profile and company, without loading them."""
+		return Database.result(
+			Database.session.execute(
+				select(User.id, Profile.id, Company.id)
+				.join(Profile, Profile.user_id == User.id)
+				.outerjoin(Company, Company.owner_id == User.id)
+				.where(User.access_token == access_token)
+			),
+			lambda result: result.first()
+		)
+
 
 class Profile(Model, LocationMixin):
 	"""User's profile model."""
@@ -65,10 +79,16 @@ class Profile(Model, LocationMixin):
 		lazy='dynamic',
 		order_by='desc(Chat.ts_update)'
 	)
-
-	@property
-	def shops(self) -> list:
-		return self.user.company.shops if self.user.company else []
+	# Shops of the user's company, loadable in one query for many profiles.
+	shops = relationship(
+		'Shop',
+		# names of secondary are resolved as tables
+		secondary='join(User, Company, Company.c.owner_id == User.c.id)',
+		primaryjoin='Profile.user_id == User.id',
+		secondaryjoin='Shop.company_id == Company.id',
+		order_by='Shop.id',
+		viewonly=True
+	)
 
 
 class Device(Model):
@@ -1,43 +1,196 @@
-"""Push notifications handler."""
+"""Push notifications dispatcher."""
 
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
 from os import environ
 
 from pyfcm import FCMNotification
 from pyfcm.errors import FCMError
+from requests import RequestException
+from sqlalchemy.sql import update
+from starlette.concurrency import run_in_threadpool
 
-from quicksell.models import Chat, Device
+from quicksell.database import Database
+from quicksell.models import Chat, Device, Message
 from quicksell.schemas import MessageRetrieve
 
-push_service = FCMNotification(api_key=environ['FCM_KEY'])
 
+@dataclass
+class Notification:
+	"""Notification for all active devices of the users."""
 
-async def push(device: Device, title=None, body=None, data=None):
-	if device.is_active:
+	user_ids: list[int]
+	title: str = None
+	body: str = None
+	data: dict = field(default_factory=dict)
+
+
+class Transport(ABC):
+	"""Delivers a notification to a batch of device tokens."""
+
+	MAX_BATCH = 500
+
+	@abstractmethod
+	async def send(self, tokens: list[str], notification: Notification):
+		"""Return delivery success for each token."""
+
+
+class FCMTransport(Transport):
+	"""Firebase Cloud Messaging multicast."""
+
+	MAX_BATCH = 1000
+
+	def __init__(self, api_key: str):
+		self.service = FCMNotification(api_key=api_key)
+
+	async def send(self, tokens, notification):
+		response = await run_in_threadpool(
+			self.service.notify_multiple_devices,
+			registration_ids=tokens,
+			message_title=notification.title,
+			message_body=notification.body,
+			data_message=notification.data
+		)
+		return ['error' not in result for result in response['results']]
+
+
+class LocalTransport(Transport):
+	"""Keeps notifications in memory instead of sending, for tests."""
+
+	def __init__(self):
+		self.sent = []
+
+	async def send(self, tokens, notification):
+		self.sent.append((tokens, notification))
+		return [True] * len(tokens)
+
+
+class Dispatcher:
+	"""Queue of notifications sent by background workers.
+
+	Devices are fetched and their failure counters updated in bulk,
+	in sessions of their own, so requests never wait for the transport.
+	"""
+
+	WORKERS = 4
+	QUEUE_SIZE = 10000
+	RETRIES = 3
+	BACKOFF = 1  # seconds, doubled on each retry
+
+	def __init__(self, transport: Transport = None):
+		self.transport = transport
+		self.queue = None
+		self.tasks = []
+
+	def push(self, user_ids, title=None, body=None, data=None):
+		if not user_ids or self.queue is None:
+			return
 		try:
-			response = push_service.notify_single_device(
-				registration_id=device.fcm_id,
-				message_title=title,
-				message_body=body,
-				data_message=data
+			self.queue.put_nowait(Notification(list(user_ids), title, body, data))
+		except asyncio.QueueFull:
+			logging.warning("Push queue is full, notification dropped")
+
+	async def work(self):
+		while True:
+			notification = await self.queue.get()
+			try:
+				await self.dispatch(notification)
+			except Exception:  # pylint: disable=broad-except
+				logging.exception("Push dispatch failed")
+			finally:
+				self.queue.task_done()
+
+	async def dispatch(self, notification: Notification):
+		async with Database.start_async_session():
+			devices = await Device.select(
+				Device.owner_id.in_(notification.user_ids), Device.is_active
 			)
-		except FCMError:
-			return
-		if response['success'] != 1:
-			device.fails_count += 1
-			if device.fails_count >= Device.MAX_FAILS:
-				device.is_active = False
-		elif device.fails_count:
-			device.fails_count = 0
+		devices = {device.fcm_id: device.id for device in devices}
+		tokens = list(devices)
+		delivered, failed = [], []
+		for start in range(0, len(tokens), self.transport.MAX_BATCH):
+			batch = tokens[start:start + self.transport.MAX_BATCH]
+			results = await self.send(batch, notification)
+			for token, success in zip(batch, results):
+				(delivered if success else failed).append(devices[token])
+		if delivered or failed:
+			async with Database.start_async_session():
+				await self.record(delivered, failed)
+
+	async def send(self, tokens, notification):
+		delay = self.BACKOFF
+		for attempt in range(self.RETRIES):
+			try:
+				return await self.transport.send(tokens, notification)
+			except (FCMError, RequestException):
+				if attempt == self.RETRIES - 1:
+					logging.exception("Push failed after %d attempts", self.RETRIES)
+					break
+				await asyncio.sleep(delay)
+				delay *= 2
+		return [False] * len(tokens)
+
+	@staticmethod
+	async def record(delivered: list[int], failed: list[int]):
+		if delivered:
+			await Database.session.execute(
+				update(Device)
+				.where(Device.id.in_(delivered), Device.fails_count != 0)
+				.values(fails_count=0)
+				.execution_options(synchronize_session=False)
+			)
+		if failed:
+			await Database.session.execute(
+				update(Device)
+				.where(Device.id.in_(failed))
+				.values(
+					fails_count=Device.fails_count + 1,
+					is_active=Device.fails_count + 1 < Device.MAX_FAILS
+				)
+				.execution_options(synchronize_session=False)
+			)
+
+	def start(self):
+		if self.transport is None:
+			self.transport = default_transport()
+		self.queue = asyncio.Queue(self.QUEUE_SIZE)
+		self.tasks = [
+			asyncio.create_task(self.work()) for _ in range(self.WORKERS)
+		]
+
+	async def stop(self, timeout=10):
+		if self.queue is not None:
+			try:
+				await asyncio.wait_for(self.queue.join(), timeout)
+			except asyncio.TimeoutError:
+				logging.warning("%d notifications dropped", self.queue.qsize())
+		for task in self.tasks:
+			task.cancel()
+		self.tasks = []
+
+
+def default_transport() -> Transport:
+	if environ.get('PUSH_TRANSPORT', 'fcm') == 'local':
+		return LocalTransport()
+	return FCMTransport(environ['FCM_KEY'])
+
+
+dispatcher = Dispatcher()
 
 
-async def notify_chat_members(chat: Chat):
-	message = chat.last_message
+def notify_chat_members(chat: Chat, message: Message):
 	title = f"{message.author.name} @ {chat.subject}"
 	data = {
 		'type': 'chat_message',
 		'chat': chat.uuid.hex,
 		'message': MessageRetrieve.from_orm(message).json()
 	}
-	for profile in chat.members:
-		if profile is not message.author and profile.user.device:
-			await push(profile.user.device, title, message.text, data)
+	dispatcher.push(
+		[
+			profile.user_id for profile in chat.members
+			if profile.id != message.author_id
+		],
+		title, message.text, data
+	)
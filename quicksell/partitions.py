@@ -0,0 +1,48 @@
+"""Monthly partitions kept ahead of time."""
+
+import asyncio
+import logging
+
+from sqlalchemy.sql import func, select
+
+from quicksell.database import Database
+
+
+class PartitionKeeper:
+	"""Creates partitions of the coming months for partitioned tables.
+
+	Migrations create them too, this keeps long running deployments from
+	running out of partitions for new rows.
+	"""
+
+	INTERVAL = 6 * 3600  # seconds
+
+	def __init__(self):
+		self.task = None
+
+	@staticmethod
+	async def create():
+		async with Database.start_async_session():
+			for table, months in Database.partitioned.items():
+				await Database.session.execute(
+					select(func.create_month_partitions(table, months))
+				)
+
+	async def run(self):
+		while True:
+			try:
+				await self.create()
+			except Exception:  # pylint: disable=broad-except
+				logging.exception("Failed to create partitions")
+			await asyncio.sleep(self.INTERVAL)
+
+	def start(self):
+		self.task = asyncio.create_task(self.run())
+
+	def stop(self):
+		if self.task:
+			self.task.cancel()
+			self.task = None
+
+
+partition_keeper = PartitionKeeper()
@@ -0,0 +1,95 @@
+"""Custom responses."""
+
+import re
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)')
+ZEROCOPY = 'http.response.zerocopysend'
+
+
+def byte_range(header: str, size: int) -> tuple[int, int]:
+	"""Start and end (exclusive) of a single range of Range header.
+
+	None if the header should be ignored, as multiple ranges are, and
+	ValueError if the range is not satisfiable.
+	"""
+	match = RANGE_PATTERN.fullmatch(header.strip())
+	if not match or not any(match.groups()):
+		return None
+	first, last = match.groups()
+	if not first:  # suffix: last N bytes
+		start, end = max(size - int(last), 0), size
+	else:
+		start = int(first)
+		end = min(int(last) + 1, size) if last else size
+	if start >= end:
+		raise ValueError(header)
+	return start, end
+
+
+class FileRangeResponse(Response):
+	"""File or a byte range of it.
+
+	Sent with zero-copy sendfile when the server supports ASGI zerocopysend
+	extension, otherwise read by chunks in the thread pool.
+	"""
+
+	CHUNK_SIZE = 64 * 1024
+
+	def __init__(
+		self, path: str, start: int, end: int, status_code: int = 200,
+		headers: dict = None, media_type: str = None
+	):
+		super().__init__(
+			status_code=status_code, headers=headers, media_type=media_type
+		)
+		self.path = path
+		self.start = start
+		self.count = end - start
+		self.headers['content-length'] = str(self.count)
+
+	async def __call__(self, scope: Scope, receive: Receive, send: Send):
+		await send({
+			'type': 'http.response.start',
+			'status': self.status_code,
+			'headers': self.raw_headers,
+		})
+		if scope['method'] == 'HEAD':
+			await send({'type': 'http.response.body', 'body': b''})
+			return
+		# pylint: disable=consider-using-with
+		file = await run_in_threadpool(open, self.path, 'rb')
+		try:
+			if ZEROCOPY in scope.get('extensions', {}):
+				await send({
+					'type': ZEROCOPY,
+					'file': file,
+					'offset': self.start,
+					'count': self.count,
+					'more_body': False,
+				})
+			else:
+				await self.send_chunks(file, send)
+		finally:
+			await run_in_threadpool(file.close)
+
+	async def send_chunks(self, file, send: Send):
+		await run_in_threadpool(file.seek, self.start)
+		remaining = self.count
+		while remaining:
+			chunk = await run_in_threadpool(
+				file.read, min(self.CHUNK_SIZE, remaining)
+			)
+			if not chunk:  # truncated, can't happen to immutable files
+				break
+			remaining -= len(chunk)
+			await send({
+				'type': 'http.response.body',
+				'body': chunk,
+				'more_body': bool(remaining),
+			})
+		if remaining:
+			await send({'type': 'http.response.body', 'body': b''})
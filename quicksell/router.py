@@ -1,21 +1,74 @@
 """Custom FastAPI route class for managing DB session in routes."""
 
+from functools import wraps
+from inspect import Parameter, signature
 from typing import Callable
 
 from fastapi import Request, Response
 from fastapi.routing import APIRoute, APIRouter
 
 from quicksell.database import Database
+from quicksell.serializers import serializer
 
 
 class DBSessionAPIRoute(APIRoute):
-    """Starts session before entering route."""
+    """Starts session before entering route.
+
+    Objects returned for ResponseSchema models are encoded by precompiled
+    serializers instead of validating and encoding them with pydantic,
+    the response model only documents the route.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        self.serialize = serializer(kwargs.get('response_model'))
+        # included routers create their routes again from the endpoints
+        if self.serialize and not hasattr(endpoint, 'serialize'):
+            endpoint = self.serialized(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    def serialized(self, endpoint: Callable) -> Callable:
+        """Endpoint returning the Response of the serialized content.
+
+        FastAPI doesn't apply the status and headers set on the injected
+        response to returned responses, so the endpoint is given one.
+        """
+        parameters = signature(endpoint).parameters
+        name = next((
+            name for name, parameter in parameters.items()
+            if parameter.annotation is Response
+        ), None)
+        injected = name is None
+        if injected:
+            name = 'serialized_response'
+            parameters = (
+                *parameters.values(),
+                Parameter(name, Parameter.KEYWORD_ONLY, annotation=Response)
+            )
+
+        @wraps(endpoint)
+        async def serialized_endpoint(**kwargs):
+            response = kwargs.pop(name) if injected else kwargs[name]
+            content = await endpoint(**kwargs)
+            if isinstance(content, Response):
+                return content
+            serialized = Response(
+                self.serialize(content), media_type='application/json',
+                status_code=response.status_code or self.status_code or 200
+            )
+            serialized.headers.raw.extend(response.headers.raw)
+            return serialized
+        if injected:
+            serialized_endpoint.__signature__ = signature(endpoint).replace(
+                parameters=parameters
+            )
+        serialized_endpoint.serialize = self.serialize
+        return serialized_endpoint
 
     def get_route_handler(self) -> Callable:
         original_route_handler = super().get_route_handler()
 
         async def database_session_route_hander(request: Request) -> Response:
-            with Database.start_session():
+            async with Database.start_async_session():
                 return await original_route_handler(request)
 
         return database_session_route_hander
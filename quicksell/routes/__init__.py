@@ -1,7 +1,9 @@
 """API routes."""
 
 from .chats import router as chats_router
+from .events import router as events_router
 from .listings import router as listings_router
+from .media import router as media_router
 from .offers import router as offers_router
 from .shops import router as shops_router
 from .users import router as users_router
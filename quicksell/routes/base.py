@@ -1,42 +1,82 @@
 """Routes helpers."""
 
+import enum
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as B64DecodeError
 from contextlib import contextmanager
-from typing import Type
+from typing import NamedTuple, Optional, Type
 
-from fastapi import Depends
+from fastapi import Depends, Response
 from fastapi.security import OAuth2PasswordBearer
 
-from quicksell.exceptions import Conflict, Forbidden, NotFound, Unauthorized
-from quicksell.models import UniqueViolation, User
+from quicksell.cache import identities
+from quicksell.exceptions import (
+	BadRequest, Conflict, Forbidden, NotFound, Unauthorized
+)
+from quicksell.models import InvalidCursor, Page, UniqueViolation, User
 from quicksell.schemas import HexUUID
 
 TOKEN_URL = '../users/auth/'
+CURSOR_HEADER = 'X-Next-Cursor'
 
 
-def current_user(required: bool = True):
+class Identity(NamedTuple):
+	"""Authenticated user's ids."""
+
+	token: str
+	id: int
+	profile_id: int
+	company_id: Optional[int]
+
+
+async def identify(token: str) -> Identity:
+	if identity := identities.get(token):
+		return identity
+	if ids := await User.identify(token):
+		identity = Identity(token, *ids)
+		identities.set(token, identity)
+		return identity
+	return None
+
+
+def current_identity(required: bool = True):
 	oauth = OAuth2PasswordBearer(tokenUrl=TOKEN_URL, auto_error=required)
 
-	async def fetch_user(token: str = Depends(oauth)) -> User:
-		if user := User.scalar(User.access_token == token):
-			return user
+	async def fetch_identity(token: str = Depends(oauth)) -> Identity:
+		if token and (identity := await identify(token)):
+			return identity
 		if not required:
 			return None
 		raise Unauthorized()
+	return fetch_identity
+
+
+def current_user(required: bool = True, options: tuple = ()):
+	async def fetch_user(
+		identity: Identity = Depends(current_identity(required))
+	) -> User:
+		if identity is None:
+			return None
+		return await User.scalar(User.id == identity.id, options=options)
 	return fetch_user
 
 
-def fetch(cls: Type, *filters):
+def fetch(cls: Type, *filters, options: tuple = ()):
 	async def fetch_object(uuid: HexUUID):
-		obj = cls.scalar(cls.uuid == uuid, *filters)
+		obj = await cls.scalar(cls.uuid == uuid, *filters, options=options)
 		if not obj:
 			raise NotFound(cls.__name__ + " not found")
 		return obj
 	return fetch_object
 
 
-def fetch_allowed(cls: Type, *filters):
-	async def fetch_object(uuid: HexUUID, user: User = Depends(current_user())):
-		obj = await fetch(cls, *filters)(uuid)
+def fetch_allowed(cls: Type, *filters, options: tuple = ()):
+	async def fetch_object(
+		uuid: HexUUID,
+		user: Identity = Depends(current_identity())
+	):
+		obj = await fetch(cls, *filters, options=options)(uuid)
 		if not obj.allowed(user):
 			raise Forbidden()
 		return obj
@@ -49,3 +89,46 @@ def unique_violation_check():
 		yield
 	except UniqueViolation as e:
 		raise Conflict(str(e)) from e
+
+
+def encode_cursor(key: tuple) -> str:
+	ordering, value, row_id = key
+	if isinstance(value, enum.Enum):
+		value = value.name
+	payload = json.dumps([ordering, value, row_id], separators=(',', ':'))
+	return urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def cursor_key(cursor: str = None) -> tuple:
+	"""Decode opaque `cursor` query parameter into a pagination key.
+
+	Its value is checked against the ordering by Model.paginate.
+	"""
+	if not cursor:
+		return None
+	try:
+		ordering, value, row_id = json.loads(
+			urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+		)
+	except (B64DecodeError, UnicodeDecodeError, ValueError, TypeError) as e:
+		raise BadRequest("Invalid cursor") from e
+	if not isinstance(ordering, str) or type(row_id) is not int:
+		raise BadRequest("Invalid cursor")
+	return ordering, value, row_id
+
+
+def before_key(before: str = None) -> tuple:
+	"""Decode `before` cursor of history, older than the loaded rows."""
+	return cursor_key(before)
+
+
+async def paginated(response: Response, cls: Type, *filters, **kwargs) -> Page:
+	"""Page of `cls.paginate`, the cursor of the next one set as the header."""
+	try:
+		page = cls.paginate(*filters, **kwargs)
+	except InvalidCursor as e:
+		raise BadRequest("Invalid cursor") from e
+	page = await page
+	if page.next_key is not None:
+		response.headers[CURSOR_HEADER] = encode_cursor(page.next_key)
+	return page
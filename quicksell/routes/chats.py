@@ -1,68 +1,128 @@
 """api/chats/"""
 
-from fastapi import Body, Depends, Response
+from fastapi import BackgroundTasks, Body, Depends, Response
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.sql import update
 from starlette.status import HTTP_201_CREATED, HTTP_204_NO_CONTENT
 
-from quicksell.models import Chat, Listing, Message, Profile, User
+from quicksell.database import Database
+from quicksell.events import events
+from quicksell.models import Chat, Inbox, Listing, Message, User
 from quicksell.notifications import notify_chat_members
 from quicksell.router import Router
 from quicksell.schemas import ChatRetrieve, HexUUID, MessageRetrieve
 
-from .base import current_user, fetch, fetch_allowed
+from .base import (
+	Identity, before_key, current_identity, current_user, cursor_key, fetch,
+	fetch_allowed, paginated
+)
 
 router = Router(prefix='/chats', tags=['Chats'])
+with_members = (selectinload(Chat.members),)  # to check access
+
+
+def member_user_ids(chat: Chat) -> list[int]:
+	return [profile.user_id for profile in chat.members]
 
 
 @router.get('/', response_model=list[ChatRetrieve])
 async def get_chats(
+	response: Response,
 	page: int = 0,
-	user: User = Depends(current_user())
+	after: tuple = Depends(cursor_key),
+	user: Identity = Depends(current_identity())
 ):
-	return Chat.paginate(
-		Chat.members.any(Profile.id == user.profile.id),
-		order_by=Chat.ts_update.desc(), page=page
+	return await paginated(
+		response, Inbox, Inbox.profile_id == user.profile_id,
+		order_by='-ts_update', page=page, after=after,
+		options=ChatRetrieve.options()
 	)
 
 
 @router.post('/', response_model=ChatRetrieve, status_code=HTTP_201_CREATED)
 async def create_chat(
 	listing_uuid: HexUUID = Body(...),
-	user: User = Depends(current_user())
+	user: User = Depends(current_user(options=(joinedload(User.profile),)))
 ):
-	listing = await fetch(Listing)(listing_uuid)
-	return (
-		Chat.scalar(
-			Chat.listing == listing,
-			Chat.members.any(Profile.id == user.profile.id)
-		)
-		or Chat.insert(
+	listing = await fetch(
+		Listing, options=(joinedload(Listing.seller),)
+	)(listing_uuid)
+	inbox = await Inbox.scalar(
+		Inbox.profile_id == user.profile.id,
+		Inbox.chat.has(Chat.listing_id == listing.id),
+		options=ChatRetrieve.options()
+	)
+	if not inbox:
+		chat = await Chat.insert(
 			listing=listing, subject=listing.title,
-			members=list({user.profile, listing.seller})
+			members=list({user.profile, listing.seller}),
+			options=with_members
 		)
-	)
+		# rows of the members are added by the trigger
+		inbox = await Inbox.scalar(
+			Inbox.profile_id == user.profile.id, Inbox.chat_id == chat.id,
+			options=ChatRetrieve.options()
+		)
+		await events.publish(member_user_ids(chat), 'chat', inbox)
+	return inbox
 
 
 @router.get('/{uuid}/', response_model=list[MessageRetrieve])
 async def get_chat_messages(
+	response: Response,
 	page: int = 0,
-	chat: Chat = Depends(fetch_allowed(Chat))
+	after: tuple = Depends(cursor_key),
+	before: tuple = Depends(before_key),
+	chat: Chat = Depends(fetch_allowed(Chat, options=with_members))
 ):
-	return Message.paginate(
-		Message.chat == chat, order_by=Message.ts_spawn.desc(), page=page
+	"""Messages from the latest, `before` is the cursor of the oldest loaded.
+
+	Keys include ts_spawn, so only partitions of the period are scanned.
+	"""
+	return await paginated(
+		response, Message, Message.chat_id == chat.id, order_by='-ts_spawn',
+		page=page, after=before or after, options=MessageRetrieve.options()
 	)
 
 
 @router.post('/{uuid}/', response_model=MessageRetrieve, status_code=HTTP_201_CREATED)  # noqa
 async def create_message(
+	background_tasks: BackgroundTasks,
 	text: str = Body(...),
-	chat: Chat = Depends(fetch_allowed(Chat)),
-	user: User = Depends(current_user())
+	chat: Chat = Depends(fetch_allowed(Chat, options=with_members)),
+	user: Identity = Depends(current_identity())
 ):
-	chat.last_message = Message.insert(text=text, chat=chat, author=user.profile)
-	await notify_chat_members(chat)
-	return chat.last_message
+	message = await Message.insert(
+		text=text, chat=chat, author_id=user.profile_id,
+		options=MessageRetrieve.options()
+	)
+	await events.publish(
+		member_user_ids(chat), 'message', message, chat=chat.uuid.hex
+	)
+	background_tasks.add_task(notify_chat_members, chat, message)  # after commit
+	return message
+
+
+@router.post('/{uuid}/read/', response_class=Response, status_code=HTTP_204_NO_CONTENT)  # noqa
+async def mark_chat_read(
+	chat: Chat = Depends(fetch_allowed(Chat, options=with_members)),
+	user: Identity = Depends(current_identity())
+):
+	await Database.session.execute(
+		update(Inbox)
+		.where(Inbox.profile_id == user.profile_id, Inbox.chat_id == chat.id)
+		.values(unread=0)
+		.execution_options(synchronize_session=False)
+	)
+	# other connections of the user
+	await events.publish([user.id], 'chat_read', chat=chat.uuid.hex)
 
 
 @router.delete('/{uuid}/', response_class=Response, status_code=HTTP_204_NO_CONTENT)  # noqa
-async def delete_chat(chat: Chat = Depends(fetch_allowed(Chat))):
-	chat.delete()
+async def delete_chat(
+	chat: Chat = Depends(fetch_allowed(Chat, options=with_members))
+):
+	await chat.delete()
+	await events.publish(
+		member_user_ids(chat), 'chat_deleted', chat=chat.uuid.hex
+	)
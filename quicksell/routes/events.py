@@ -0,0 +1,58 @@
+"""api/events/"""
+
+import asyncio
+
+from fastapi import WebSocket
+from starlette.status import WS_1008_POLICY_VIOLATION
+
+from quicksell.database import Database
+from quicksell.events import events
+from quicksell.router import Router
+
+from .base import identify
+
+# FastAPI ignores prefixes of routers for their own WebSocket routes
+router = Router(tags=['Events'])
+
+
+async def send_events(websocket: WebSocket, queue: asyncio.Queue):
+	while isinstance(text := await queue.get(), str):
+		await websocket.send_text(text)
+	# overflowed, so the client reconnects and reloads what it shows,
+	# or the token was revoked
+	await websocket.close(text)
+
+
+async def receive_until_closed(websocket: WebSocket):
+	while (await websocket.receive())['type'] != 'websocket.disconnect':
+		pass  # clients send nothing
+
+
+@router.websocket('/events/')
+async def user_events(websocket: WebSocket, token: str = None):
+	"""Chat messages and updates of the user, replacing polling.
+
+	Browsers can't set headers of WebSockets, so the token may be passed
+	as the query parameter.
+	"""
+	header = websocket.headers.get('Authorization', '')
+	token = token or header.removeprefix('Bearer ')
+	identity = None
+	if token:
+		async with Database.start_async_session():
+			identity = await identify(token)
+	if not identity:
+		await websocket.close(WS_1008_POLICY_VIOLATION)
+		return
+	await websocket.accept()
+	with events.connect(identity.id, token) as queue:
+		tasks = {
+			asyncio.create_task(send_events(websocket, queue)),
+			asyncio.create_task(receive_until_closed(websocket)),
+		}
+		try:
+			await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,46 +1,69 @@
 """api/listings/"""
 
-import os
 from time import time
-from uuid import uuid4
 
-from fastapi import Body, Depends, File, Query, Request, Response, UploadFile
-from sqlalchemy import func
-from starlette.status import HTTP_201_CREATED, HTTP_204_NO_CONTENT
+from fastapi import BackgroundTasks, Body, Depends, Query, Request, Response
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import update
+from starlette.status import (
+	HTTP_201_CREATED, HTTP_204_NO_CONTENT, HTTP_304_NOT_MODIFIED
+)
 
+from quicksell.cache import listings_cache
+from quicksell.categories import categories
+from quicksell.counters import view_counter
+from quicksell.database import Database
 from quicksell.exceptions import BadRequest, NotFound
-from quicksell.models import (
-	Category, Listing, Profile, UniqueViolation, User, View
-)
+from quicksell.media import UPLOAD_SCHEMA, image_pipeline, receive_photos
+from quicksell.models import Category, Listing, Profile, User
 from quicksell.router import Router
 from quicksell.schemas import (
 	HexUUID, ListingCreate, ListingRetrieve, ListingUpdate
 )
+from quicksell.serializers import serializer
 
-from .base import current_user, fetch, fetch_allowed
+from .base import (
+	Identity, current_identity, current_user, cursor_key, fetch, fetch_allowed,
+	paginated
+)
 
 router = Router(prefix='/listings', tags=['Listings'])
+dump_listings = serializer(list[ListingRetrieve])
 
 
-@router.get('/', response_model=list[ListingRetrieve])
-async def get_listings_list(
-	# pylint: disable=too-many-arguments
-	user: User = Depends(current_user(required=False)),
-	title: str = None,
-	min_price: int = None,
-	max_price: int = None,
-	is_new: bool = None,
-	category: list[str] = Query(None),
-	seller_uuid: HexUUID = None,
-	distance: int = None,
-	latitude: float = None,
-	longitude: float = None,
-	order_by: str = '-ts_spawn',
-	page: int = 0
-):
-	filters = []
+async def assignable_category(name: str) -> Category:
+	category = categories.get(name)
+	if not category or not category.assignable:
+		raise BadRequest("Invalid category")
+	# registry's copy is merged into the session without querying
+	return await Database.session.merge(category, load=False)
+
+
+def listing_search(
+	# pylint: disable=too-many-arguments, too-many-branches
+	user: Identity, title: str = None, min_price: int = None,
+	max_price: int = None, is_new: bool = None, category: list[str] = None,
+	seller_uuid: HexUUID = None, distance: int = None, latitude: float = None,
+	longitude: float = None, order_by: str = '-ts_spawn'
+) -> tuple[list, list, str]:
+	"""Filters, labeled columns and ordering of the listings search.
+
+	Used by benchmarks/listing_plans.py to check the plans of the route.
+	"""
+	filters, columns = [Listing.active()], []
 	if title and len(title) >= 3:
-		filters.append(Listing.title.ilike(f'%{title}%'))
+		filters.append(Listing.matches(title))
+		if order_by == 'relevance':
+			columns.append(Listing.relevance(title))
+			order_by = '-relevance'
+	if latitude is not None and longitude is not None:
+		columns.append(Listing.distance_to(latitude, longitude))
+		if distance:
+			filters.append(Listing.in_range(latitude, longitude, distance))
+	sort_by = order_by.removeprefix('-')
+	if sort_by in ('relevance', 'distance') \
+		and sort_by not in (column.name for column in columns):
+		order_by = '-ts_spawn'
 	if min_price is not None and min_price >= 0:
 		filters.append(Listing.price >= min_price)
 	if max_price is not None and max_price >= 0:
@@ -48,113 +71,147 @@ async def get_listings_list(
 	if is_new is not None:
 		filters.append(Listing.is_new == is_new)
 	if category:
-		filters.append(Listing.category_id == Category.id)
-		filters.append(Category.name.in_(category))
+		filters.append(
+			Listing.category_id.in_(sorted(categories.descendant_ids(category)))
+		)
 	if seller_uuid:
 		filters.append(Listing.seller_id == Profile.id)
 		filters.append(Profile.uuid == seller_uuid)
-	if distance and latitude and longitude:
-		distance_column = (
-			func.pow(Listing.latitude - latitude, 2)
-			+ func.pow(Listing.longitude - longitude, 2)
-		).label('distance')
-		filters.append(distance_column <= distance ** 2)
-	if not user or not user.company:
+	if not user or not user.company_id:
 		ts_filter = Listing.ts_spawn < int(time()) - Listing.PUBLICATION_DELAY
 		if user and not seller_uuid:
-			ts_filter |= Listing.seller_id == user.profile.id
+			ts_filter |= Listing.seller_id == user.profile_id
 		filters.append(ts_filter)
-	return Listing.paginate(*filters, order_by=order_by, page=page)
+	return filters, columns, order_by
+
+
+@router.get('/', response_model=list[ListingRetrieve])
+async def get_listings_list(
+	# pylint: disable=too-many-arguments, too-many-locals
+	response: Response,
+	user: Identity = Depends(current_identity(required=False)),
+	title: str = None,
+	min_price: int = None,
+	max_price: int = None,
+	is_new: bool = None,
+	category: list[str] = Query(None),
+	seller_uuid: HexUUID = None,
+	distance: int = None,
+	latitude: float = None,
+	longitude: float = None,
+	order_by: str = '-ts_spawn',
+	page: int = 0,
+	after: tuple = Depends(cursor_key)
+):
+	if title:
+		title = ' '.join(title.split())
+	key = None
+	# everyone but companies and sellers looking for their own listings
+	# sees the same delayed listings
+	if not user or (not user.company_id and seller_uuid):
+		key = listings_cache.key(
+			title=title if title and len(title) >= 3 else None,
+			min_price=min_price, max_price=max_price, is_new=is_new,
+			category=sorted(set(category or ())), categories=categories.version,
+			seller_uuid=seller_uuid and seller_uuid.hex, distance=distance,
+			latitude=latitude, longitude=longitude, order_by=order_by,
+			page=page, after=after
+		)
+		if cached := await listings_cache.get(key):
+			body, headers = cached
+			return Response(body, media_type='application/json', headers=headers)
+	filters, columns, order_by = listing_search(
+		user, title=title, min_price=min_price, max_price=max_price,
+		is_new=is_new, category=category, seller_uuid=seller_uuid,
+		distance=distance, latitude=latitude, longitude=longitude,
+		order_by=order_by
+	)
+	listings = await paginated(
+		response, Listing, *filters, order_by=order_by, page=page, after=after,
+		columns=columns, options=ListingRetrieve.options()
+	)
+	if not key:
+		return listings
+	body = dump_listings(listings)
+	headers = dict(response.headers)
+	await listings_cache.set(key, body, headers)
+	return Response(body, media_type='application/json', headers=headers)
 
 
 @router.post('/', response_model=ListingRetrieve, status_code=HTTP_201_CREATED)
 async def create_listing(
 	body: ListingCreate,
-	user: User = Depends(current_user())
+	user: User = Depends(current_user(options=(joinedload(User.profile),)))
 ):
 	params = body.dict()
 	location = params.pop('location', user.profile.location)
 	if not location:
 		raise BadRequest("Location not provided and user didn't set a default one")
-	category = Category.scalar(Category.name == params.pop('category'))
-	if not category or not category.assignable:
-		raise BadRequest("Invalid category")
-	return Listing.insert(
-		**params, location=location, category=category, seller=user.profile
+	category = await assignable_category(params.pop('category'))
+	return await Listing.insert(
+		**params, location=location, seller=user.profile, category=category,
+		options=ListingRetrieve.options()
 	)
 
 
 @router.get('/categories/')
-async def categories_tree():
-	if Category.cached_tree:
-		return Category.cached_tree
-	categories = {cat.id: cat for cat in Category.select()}
-	tree = {}
-	for category in categories.values():
-		category_branch = {}
-		tree[category.name] = category_branch
-		if category.parent_id:
-			parent_name = categories[category.parent_id].name
-			tree.setdefault(parent_name, {})[category.name] = category_branch
-	for category in categories.values():
-		if category.parent_id:
-			tree.pop(category.name)
-	Category.cached_tree = tree
-	return tree
+async def categories_tree(request: Request):
+	etag = f'"{categories.version}"'
+	headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+	if request.headers.get('If-None-Match') == etag:
+		return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+	return Response(
+		categories.tree_json, media_type='application/json', headers=headers
+	)
 
 
 @router.get('/{uuid}/', response_model=ListingRetrieve)
 async def get_listing(
 	request: Request,
-	listing: Listing = Depends(fetch(Listing))
+	listing: Listing = Depends(fetch(Listing, options=ListingRetrieve.options()))
 ):
-	ip = request.client.host
-	try:
-		View.insert(listing_id=listing.id, ip=ip)
-	except UniqueViolation:
-		pass
-	else:
-		listing.views += 1
+	view_counter.add(listing.id, request.client.host)
 	return listing
 
 
 @router.patch('/{uuid}/', response_model=ListingRetrieve)
 async def update_listing(
 	body: ListingUpdate,
-	listing: Listing = Depends(fetch_allowed(Listing))
+	listing: Listing = Depends(
+		fetch_allowed(Listing, options=ListingRetrieve.options())
+	)
 ):
 	params = body.dict()
 	if category_name := params.get('category'):
-		category = Category.scalar(Category.name == category_name)
-		if not category or not category.assignable:
-			raise BadRequest("Invalid category")
-		params['category'] = category
-	return listing.update(**params)
+		params['category'] = await assignable_category(category_name)
+	return await listing.update(**params)
 
 
 @router.delete('/{uuid}/', response_class=Response, status_code=HTTP_204_NO_CONTENT)  # noqa
 async def delete_listing(listing: Listing = Depends(fetch_allowed(Listing))):
-	listing.delete()
-	for filename in listing.photos:
-		try:
-			os.remove(f'media/{filename}')
-		except FileNotFoundError:
-			pass
+	await listing.delete()  # photos are collected when unreferenced
 
 
-@router.post('/{uuid}/photos/', status_code=HTTP_201_CREATED)
-async def upload_photo(
-	file: UploadFile = File(...),
+@router.post(
+	'/{uuid}/photos/', response_model=list[str], status_code=HTTP_201_CREATED,
+	openapi_extra=UPLOAD_SCHEMA
+)
+async def upload_photos(
+	request: Request,
+	background_tasks: BackgroundTasks,
 	listing: Listing = Depends(fetch_allowed(Listing))
 ):
-	if file.content_type not in ('image/jpg', 'image/png'):
-		raise BadRequest("Wrong file type")
-	filename = f"{uuid4().hex}.{file.content_type.split('/')[-1]}"
-	with open('media/' + filename, 'wb') as f:
-		f.write(await file.read())
-	listing.photos.append(filename)
-	listing.save()
-	return filename
+	# don't hold a database connection while the client is uploading
+	await Database.session.commit()
+	filenames = await receive_photos(request)
+	await Database.session.execute(
+		update(Listing)
+		.where(Listing.id == listing.id)
+		.values(photos=Listing.photos + filenames)
+		.execution_options(synchronize_session=False)
+	)
+	background_tasks.add_task(image_pipeline.push, listing.id, filenames)
+	return filenames
 
 
 @router.delete('/{uuid}/photos/', response_class=Response, status_code=HTTP_204_NO_CONTENT)  # noqa
@@ -166,8 +223,5 @@ async def delete_photo(
 		listing.photos.remove(filename)
 	except ValueError as e:
 		raise NotFound("File not found") from e
-	listing.save()
-	try:
-		os.remove(f'media/{filename}')
-	except FileNotFoundError:
-		pass
+	listing.photo_variants.pop(filename, None)
+	await listing.save()
@@ -0,0 +1,103 @@
+"""api/media/"""
+
+import os
+from os import environ
+
+from fastapi import Depends, Request, Response
+from fastapi.responses import RedirectResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.status import (
+	HTTP_201_CREATED, HTTP_206_PARTIAL_CONTENT, HTTP_304_NOT_MODIFIED
+)
+
+from quicksell.exceptions import NotFound, RangeNotSatisfiable
+from quicksell.media import UPLOAD_SCHEMA, receive_photos
+from quicksell.responses import FileRangeResponse, byte_range
+from quicksell.router import Router
+from quicksell.storage import IMMUTABLE, content_type, is_media_key, storage
+
+from .base import Identity, current_identity
+
+router = Router(prefix='/media', tags=['Media'])
+
+
+@router.post(
+	'/', response_model=list[str], status_code=HTTP_201_CREATED,
+	openapi_extra=UPLOAD_SCHEMA
+)
+async def upload_media(
+	request: Request,
+	_: Identity = Depends(current_identity())
+):
+	# for avatar, shop photo or company logo, kept while referenced there
+	return await receive_photos(request)
+
+
+# 'x-accel-redirect' for nginx, 'x-sendfile' for Apache or lighttpd
+OFFLOAD = environ.get('MEDIA_OFFLOAD', '').lower()
+# nginx internal location aliased to the media directory
+ACCEL_PREFIX = environ.get('MEDIA_ACCEL_PREFIX', '/internal-media/')
+REDIRECT_CACHE = 'private, max-age=3600'  # while the signed URL is valid
+
+
+def etag_matches(header: str, etag: str) -> bool:
+	return header.strip() == '*' or etag in (
+		tag.strip().removeprefix('W/') for tag in header.split(',')
+	)
+
+
+def file_size(path: str) -> int:
+	try:
+		return os.stat(path).st_size
+	except FileNotFoundError:
+		return None
+
+
+@router.api_route(
+	'/{key:path}', methods=['GET', 'HEAD'], response_class=Response,
+	include_in_schema=False
+)
+async def get_media(key: str, request: Request):
+	"""Files never change, so they are cached by clients for good.
+
+	The key is the strong ETag: content hash or random name.
+	"""
+	if not is_media_key(key):
+		raise NotFound("File not found")
+	if url := storage.url(key):
+		return RedirectResponse(url, headers={'Cache-Control': REDIRECT_CACHE})
+	headers = {
+		'Cache-Control': IMMUTABLE,
+		'ETag': f'"{os.path.basename(key)}"',
+		'Accept-Ranges': 'bytes',
+	}
+	if etag_matches(request.headers.get('If-None-Match', ''), headers['ETag']):
+		return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+
+	path = storage.path(key)
+	if OFFLOAD == 'x-accel-redirect':  # proxy handles ranges itself
+		headers['X-Accel-Redirect'] = ACCEL_PREFIX + key
+		return Response(headers=headers, media_type=content_type(key))
+	if OFFLOAD == 'x-sendfile':
+		headers['X-Sendfile'] = os.path.abspath(path)
+		return Response(headers=headers, media_type=content_type(key))
+
+	size = await run_in_threadpool(file_size, path)
+	if size is None:
+		raise NotFound("File not found")
+	start, end, status_code = 0, size, 200
+	range_header = request.headers.get('Range')
+	if_range = request.headers.get('If-Range', headers['ETag'])
+	if range_header and if_range == headers['ETag']:
+		try:
+			requested = byte_range(range_header, size)
+		except ValueError as e:
+			raise RangeNotSatisfiable(
+				headers={'Content-Range': f'bytes */{size}'}
+			) from e
+		if requested:
+			(start, end), status_code = requested, HTTP_206_PARTIAL_CONTENT
+			headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+	return FileRangeResponse(
+		path, start, end, status_code, headers, content_type(key)
+	)
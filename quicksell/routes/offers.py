@@ -1,73 +1,95 @@
 """api/offers/"""
 
 from fastapi import Body, Depends, Response
+from sqlalchemy.orm import joinedload
 from starlette.status import HTTP_201_CREATED, HTTP_204_NO_CONTENT
 
 from quicksell.exceptions import BadRequest, Conflict, Forbidden
-from quicksell.models import Listing, Offer, User
+from quicksell.models import Listing, Offer
 from quicksell.router import Router
 from quicksell.schemas import OfferCreate, OfferRetrieve, OfferUpdate
 
-from .base import current_user, fetch, fetch_allowed
+from .base import (
+	Identity, current_identity, cursor_key, fetch, fetch_allowed, paginated
+)
 
 router = Router(prefix='/offers', tags=['Offers'])
 
 
 @router.get('/', response_model=list[OfferRetrieve])
-async def get_offers_list(user: User = Depends(current_user())):
-	if user.company:
-		where = [Offer.company == user.company]
+async def get_offers_list(
+	response: Response,
+	order_by: str = '-ts_spawn',
+	page: int = 0,
+	after: tuple = Depends(cursor_key),
+	user: Identity = Depends(current_identity())
+):
+	if user.company_id:
+		where = [Offer.company_id == user.company_id]
 	else:
-		where = [Offer.listing_id == Listing.id, Listing.seller == user.profile]
-	return Offer.paginate(*where, Offer.active)
+		where = [
+			Offer.listing_id == Listing.id, Listing.seller_id == user.profile_id
+		]
+	return await paginated(
+		response, Offer, *where, Offer.active, order_by=order_by, page=page,
+		after=after, options=OfferRetrieve.options()
+	)
 
 
 @router.post('/', response_model=OfferRetrieve, status_code=HTTP_201_CREATED)
 async def create_offer(
 	body: OfferCreate,
-	user: User = Depends(current_user())
+	user: Identity = Depends(current_identity())
 ):
-	if not user.company:
+	if not user.company_id:
 		raise BadRequest("You must register a company first")
 	params = body.dict()
 	listing = await fetch(Listing)(params.pop('listing_uuid'))
-	if listing.seller is user.profile:
+	if listing.seller_id == user.profile_id:
 		raise BadRequest("You can't make offers for your own listing")
-	if Offer.scalar(
+	if await Offer.scalar(
 		Offer.listing_id == listing.id,
-		Offer.company_id == user.company.id,
+		Offer.company_id == user.company_id,
 		Offer.active
 	):
 		raise Conflict("You've already made an offer for the listing")
-	return Offer.insert(**params, listing=listing, company=user.company)
+	return await Offer.insert(
+		**params, listing=listing, company_id=user.company_id,
+		options=OfferRetrieve.options()
+	)
 
 
 @router.patch('/{uuid}/', response_model=OfferRetrieve)
 async def update_offer(
 	body: OfferUpdate,
-	offer: Offer = Depends(fetch_allowed(Offer, Offer.active))
+	offer: Offer = Depends(
+		fetch_allowed(Offer, Offer.active, options=OfferRetrieve.options())
+	)
 ):
 	if offer.accepted:
 		raise BadRequest("Offer has already been accepted")
-	return offer.update(**body.dict())
+	return await offer.update(**body.dict())
 
 
 @router.put('/{uuid}/', response_class=Response)
 async def accept_offer(
 	accept: bool = Body(..., embed=True),
-	offer: Offer = Depends(fetch(Offer, Offer.active, Offer.accepted.is_(None))),
-	user: User = Depends(current_user())
+	offer: Offer = Depends(fetch(
+		Offer, Offer.active, Offer.accepted.is_(None),
+		options=(joinedload(Offer.listing),)
+	)),
+	user: Identity = Depends(current_identity())
 ):
-	if user.profile is not offer.listing.seller:
+	if offer.listing.seller_id != user.profile_id:
 		raise Forbidden("Offer is not for you")
 	if accept:
-		offer.update(accepted=True)
+		await offer.update(accepted=True)
 	else:
-		offer.update(accepted=False, active=False)
+		await offer.update(accepted=False, active=False)
 
 
 @router.delete('/{uuid}/', response_class=Response, status_code=HTTP_204_NO_CONTENT)  # noqa
 async def delete_offer(
 	offer: Offer = Depends(fetch_allowed(Offer, Offer.active))
 ):
-	offer.update(active=False)
+	await offer.update(active=False)
@@ -1,52 +1,84 @@
 """api/shops/"""
 
-from fastapi import Depends
+from fastapi import Depends, Response
 from starlette.status import HTTP_201_CREATED
 
 from quicksell.exceptions import BadRequest, Conflict
-from quicksell.models import Company, Shop, User
+from quicksell.models import Company, Shop
 from quicksell.router import Router
 from quicksell.schemas import (
 	CompanyCreate, CompanyRetrieve, ShopCreate, ShopRetrieve
 )
 
-from .base import current_user, fetch, unique_violation_check
+from .base import (
+	Identity, current_identity, cursor_key, fetch, identities, paginated,
+	unique_violation_check
+)
 
 router = Router(prefix='/shops', tags=['Shops'])
 
 
 @router.get('/', response_model=list[ShopRetrieve])
-async def get_shops_list():
-	return Shop.select()
+async def get_shops_list(
+	response: Response,
+	distance: int = None,
+	latitude: float = None,
+	longitude: float = None,
+	order_by: str = 'id',
+	page: int = 0,
+	after: tuple = Depends(cursor_key)
+):
+	filters, columns = [], []
+	if latitude is not None and longitude is not None:
+		columns.append(Shop.distance_to(latitude, longitude))
+		if distance:
+			filters.append(Shop.in_range(latitude, longitude, distance))
+	elif order_by.removeprefix('-') == 'distance':
+		order_by = 'id'
+	return await paginated(
+		response, Shop, *filters, order_by=order_by, page=page, after=after,
+		columns=columns, options=ShopRetrieve.options()
+	)
 
 
 @router.post('/', response_model=ShopRetrieve, status_code=HTTP_201_CREATED)
 async def create_shop(
 	body: ShopCreate,
-	user: User = Depends(current_user())
+	user: Identity = Depends(current_identity())
 ):
-	if not user.company:
+	if not user.company_id:
 		raise BadRequest("User doesn't have a company")
 	with unique_violation_check():
-		return Shop.insert(**body.dict(), company=user.company)
+		return await Shop.insert(
+			**body.dict(), company_id=user.company_id,
+			options=ShopRetrieve.options()
+		)
 
 
 @router.post('/companies/', response_model=CompanyRetrieve, status_code=HTTP_201_CREATED)  # noqa
 async def create_company(
 	body: CompanyCreate,
-	user: User = Depends(current_user())
+	user: Identity = Depends(current_identity())
 ):
-	if user.company:
+	if user.company_id:
 		raise Conflict("User already has a company")
 	with unique_violation_check():
-		return Company.insert(**body.dict(), owner=user)
+		company = await Company.insert(
+			**body.dict(), owner_id=user.id, options=CompanyRetrieve.options()
+		)
+	await identities.evict(user.token)
+	return company
 
 
 @router.get('/companies/{uuid}/', response_model=CompanyRetrieve)
-async def get_company(company: Company = Depends(fetch(Company))):
+async def get_company(
+	company: Company = Depends(fetch(Company, options=CompanyRetrieve.options()))
+):
 	return company
 
 
 @router.get('/{uuid}/', response_model=ShopRetrieve)
-async def get_shop(shop: Shop = Depends(fetch(Shop))):
+async def get_shop(
+	shop: Shop = Depends(fetch(Shop, options=ShopRetrieve.options()))
+):
 	return shop
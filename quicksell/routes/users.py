@@ -2,8 +2,10 @@
 
 from fastapi import Body, Depends, Response
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy.orm import joinedload, selectinload
 from starlette.status import HTTP_201_CREATED, HTTP_204_NO_CONTENT
 
+from quicksell.database import Database
 from quicksell.exceptions import Unauthorized
 from quicksell.models import Listing, Profile, User
 from quicksell.router import Router
@@ -12,57 +14,73 @@ from quicksell.schemas import (
 	UserRetrieve
 )
 from quicksell.security import (
-	check_password, generate_access_token, hash_password
+	check_password, generate_access_token, hash_password, needs_rehash
 )
 
-from .base import current_user, fetch, unique_violation_check
+from .base import current_user, fetch, identities, unique_violation_check
 
 router = Router(prefix='/users', tags=['Users'])
 
 
 @router.get('/', response_model=UserRetrieve)
-async def get_current_user(user: User = Depends(current_user())):
+async def get_current_user(
+	user: User = Depends(current_user(options=UserRetrieve.options()))
+):
 	return user
 
 
 @router.post('/', response_model=UserRetrieve, status_code=HTTP_201_CREATED)
 async def create_user(body: UserCreate):
 	with unique_violation_check():
-		return User.insert(
+		return await User.insert(
 			email=body.email,
-			password_hash=hash_password(body.password),
+			password_hash=await hash_password(body.password),
 			access_token=generate_access_token(body.email),
 			profile=Profile(phone=body.phone, name=body.name),
+			options=UserRetrieve.options()
 		)
 
 
 @router.patch('/', response_model=ProfileRetrieve)
 async def update_profile(
 	body: ProfileUpdate,
-	user: User = Depends(current_user())
+	user: User = Depends(current_user(options=(
+		joinedload(User.profile).options(*ProfileRetrieve.options()),
+	)))
 ):
 	with unique_violation_check():
-		return user.profile.update(**body.dict())
+		return await user.profile.update(**body.dict())
 
 
 @router.post('/auth/')
 async def login(auth: OAuth2PasswordRequestForm = Depends()):
-	user = User.scalar(User.email == auth.username)
-	if not user or not check_password(auth.password, user.password_hash):
+	user = await User.scalar(User.email == auth.username)
+	if not user or not await check_password(auth.password, user.password_hash):
 		raise Unauthorized()
-	user.access_token = generate_access_token(auth.username)
+	if needs_rehash(user.password_hash):
+		user.password_hash = await hash_password(auth.password)
+	old_token, user.access_token = (
+		user.access_token, generate_access_token(auth.username)
+	)
+	# the old token could be cached again until the new one is saved
+	await Database.session.commit()
+	await identities.evict(old_token)
 	return {'access_token': user.access_token}
 
 
 @router.get('/favorites/', response_model=list[ListingRetrieve])
-async def get_favorite_listings(user: User = Depends(current_user())):
+async def get_favorite_listings(
+	user: User = Depends(current_user(options=(
+		selectinload(User.favorites).options(*ListingRetrieve.options()),
+	)))
+):
 	return user.favorites
 
 
 @router.put('/favorites/', response_class=Response)
 async def favor_listing(
 	uuid: HexUUID = Body(..., embed=True),
-	user: User = Depends(current_user())
+	user: User = Depends(current_user(options=(selectinload(User.favorites),)))
 ):
 	listing = await fetch(Listing)(uuid)
 	user.favorites.append(listing)
@@ -71,7 +89,7 @@ async def favor_listing(
 @router.delete('/favorites/', response_class=Response, status_code=HTTP_204_NO_CONTENT)  # noqa
 async def remove_listing_from_favorites(
 	uuid: HexUUID = Body(..., embed=True),
-	user: User = Depends(current_user())
+	user: User = Depends(current_user(options=(selectinload(User.favorites),)))
 ):
 	listing = await fetch(Listing)(uuid)
 	try:
@@ -80,6 +98,8 @@ async def remove_listing_from_favorites(
 		pass
 
 
-@router.get('/{uuid}/')
-async def get_profile(profile: Profile = Depends(fetch(Profile))):
+@router.get('/{uuid}/', response_model=ProfileRetrieve)
+async def get_profile(
+	profile: Profile = Depends(fetch(Profile, options=ProfileRetrieve.options()))
+):
 	return profile
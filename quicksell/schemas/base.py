@@ -14,6 +14,11 @@ class ResponseSchema(BaseModel):
 			UUID: lambda uuid: uuid.hex
 		}
 
+	@classmethod
+	def options(cls) -> tuple:
+		"""Loader options for the relationships the schema reads."""
+		return ()
+
 
 class RequestSchema(BaseModel):
 	"""Base request schema."""
@@ -3,6 +3,10 @@
 from datetime import datetime
 from typing import ForwardRef, Optional
 
+from sqlalchemy.orm import joinedload, selectinload
+
+from quicksell.models import Chat, Inbox, Message
+
 from .base import HexUUID, ResponseSchema
 
 ProfileRetrieve = ForwardRef('ProfileRetrieve')
@@ -15,12 +19,25 @@ class MessageRetrieve(ResponseSchema):
 	text: str
 	ts_spawn: datetime
 
+	@classmethod
+	def options(cls):
+		return (joinedload(Message.author).options(*ProfileRetrieve.options()),)
+
 
 class ChatRetrieve(ResponseSchema):
-	"""Chat response schema."""
+	"""Chat in member's Inbox response schema."""
 
 	uuid: HexUUID
 	subject: str
 	ts_update: datetime
 	last_message: Optional[MessageRetrieve]
 	members: list[ProfileRetrieve]
+	unread: int
+
+	@classmethod
+	def options(cls):
+		return (
+			joinedload(Inbox.chat).selectinload(Chat.members)
+			.options(*ProfileRetrieve.options()),
+			joinedload(Inbox.last_message).options(*MessageRetrieve.options()),
+		)
@@ -4,6 +4,7 @@ from datetime import datetime
 from typing import ForwardRef, Optional
 
 from pydantic import conint, validator
+from sqlalchemy.orm import joinedload
 
 from quicksell.models import Listing
 
@@ -29,13 +30,22 @@ class ListingRetrieve(ResponseSchema):
 	sold: int
 	views: int
 	photos: list[str]
+	photo_variants: dict[str, dict[str, str]]
 	location: Optional[LocationSchema]
+	distance: Optional[float]
 	seller: ProfileRetrieve
 
 	@validator('category', pre=True)
 	def category_name(cls, category):  # pylint: disable=no-self-argument
 		return category.name
 
+	@classmethod
+	def options(cls):
+		return (
+			joinedload(Listing.category),
+			joinedload(Listing.seller).options(*ProfileRetrieve.options()),
+		)
+
 
 class ListingCreate(RequestSchema):
 	"""Listing creation schema."""
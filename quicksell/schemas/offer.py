@@ -4,6 +4,9 @@ from datetime import datetime
 from typing import ForwardRef, Optional
 
 from pydantic import conint
+from sqlalchemy.orm import joinedload
+
+from quicksell.models import Offer
 
 from .base import HexUUID, RequestSchema, ResponseSchema
 
@@ -22,6 +25,13 @@ class OfferRetrieve(ResponseSchema):
 	listing: ListingRetrieve
 	company: CompanyRetrieve
 
+	@classmethod
+	def options(cls):
+		return (
+			joinedload(Offer.listing).options(*ListingRetrieve.options()),
+			joinedload(Offer.company).options(*CompanyRetrieve.options()),
+		)
+
 
 class OfferCreate(RequestSchema):
 	"""Offer creation schema."""
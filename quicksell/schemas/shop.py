@@ -3,8 +3,9 @@
 from typing import Optional
 
 from pydantic import EmailStr
+from sqlalchemy.orm import joinedload
 
-from quicksell.models import Company
+from quicksell.models import Company, Shop
 
 from .base import HexUUID, LocationSchema, RequestSchema, ResponseSchema
 
@@ -29,10 +30,15 @@ class ShopRetrieve(ResponseSchema):
 	name: str
 	description: Optional[str]
 	location: LocationSchema
+	distance: Optional[float]
 	phone: str
 	photo: Optional[str]
 	company: CompanyRetrieve
 
+	@classmethod
+	def options(cls):
+		return (joinedload(Shop.company).options(*CompanyRetrieve.options()),)
+
 
 class CompanyCreate(RequestSchema):
 	"""Company creation schema."""
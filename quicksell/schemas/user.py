@@ -4,6 +4,9 @@ from datetime import datetime
 from typing import ForwardRef, Optional
 
 from pydantic import EmailStr
+from sqlalchemy.orm import joinedload, selectinload
+
+from quicksell.models import Profile, User
 
 from .base import HexUUID, RequestSchema, ResponseSchema
 
@@ -24,6 +27,11 @@ class ProfileRetrieve(ResponseSchema):
 	avatar: Optional[str]
 	shops: list[ShopRetrieve]
 
+	@classmethod
+	def options(cls):
+		# one query for all profiles of a page
+		return (selectinload(Profile.shops).options(*ShopRetrieve.options()),)
+
 
 class ProfileUpdate(RequestSchema):
 	"""Profile update schema."""
@@ -44,6 +52,13 @@ class UserRetrieve(ResponseSchema):
 	access_token: Optional[str]
 	company: Optional[CompanyRetrieve]
 
+	@classmethod
+	def options(cls):
+		return (
+			joinedload(User.profile).options(*ProfileRetrieve.options()),
+			selectinload(User.company).options(*CompanyRetrieve.options()),
+		)
+
 
 class UserCreate(RequestSchema):
 	"""User creation schema."""
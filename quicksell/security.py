@@ -1,20 +1,81 @@
 """API authorization."""
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
-from time import time
+from time import perf_counter, time
 
 import bcrypt
 from jose import jwt
 
+from quicksell import metrics
+from quicksell.exceptions import ServiceUnavailable
+
 SECRET_KEY = environ['SECRET_KEY']
+BCRYPT_ROUNDS = int(environ.get('BCRYPT_ROUNDS', 12))
+
+
+class HashingPool:
+	"""Runs bcrypt in a few threads, rejecting calls when too many are queued.
+
+	bcrypt releases the GIL, so hashing doesn't block the event loop and
+	a login storm is limited to the pool instead of the whole worker.
+	"""
+
+	def __init__(self, workers: int, max_pending: int):
+		self.executor = ThreadPoolExecutor(workers, thread_name_prefix='bcrypt')
+		self.max_pending = max_pending
+		self.pending = 0
+		self.rejected = 0
+		self.wait_timer = metrics.timer('bcrypt.wait')
+		self.run_timer = metrics.timer('bcrypt.run')
+		metrics.gauge('bcrypt.pending', lambda: self.pending)
+		metrics.gauge('bcrypt.rejected', lambda: self.rejected)
+
+	async def run(self, function, *args):
+		if self.pending >= self.max_pending:
+			self.rejected += 1
+			raise ServiceUnavailable("Too many authentication requests")
+		queued = perf_counter()
+
+		def timed():
+			started = perf_counter()
+			self.wait_timer.observe(started - queued)
+			try:
+				return function(*args)
+			finally:
+				self.run_timer.observe(perf_counter() - started)
+
+		self.pending += 1
+		try:
+			return await asyncio.get_running_loop().run_in_executor(
+				self.executor, timed
+			)
+		finally:
+			self.pending -= 1
+
+
+hashing_pool = HashingPool(
+	workers=int(environ.get('BCRYPT_WORKERS', 2)),
+	max_pending=int(environ.get('BCRYPT_MAX_PENDING', 32))
+)
+
+
+async def hash_password(password: str) -> str:
+	hashed = await hashing_pool.run(
+		bcrypt.hashpw, password.strip().encode(), bcrypt.gensalt(BCRYPT_ROUNDS)
+	)
+	return hashed.decode()
 
 
-def hash_password(password: str) -> str:
-	return bcrypt.hashpw(password.strip().encode(), bcrypt.gensalt()).decode()
+async def check_password(password: str, hashed: str) -> bool:
+	return await hashing_pool.run(
+		bcrypt.checkpw, password.encode(), hashed.encode()
+	)
 
 
-def check_password(password: str, hashed: str) -> bool:
-	return bcrypt.checkpw(password.encode(), hashed.encode())
+def needs_rehash(hashed: str) -> bool:
+	return int(hashed.split('$')[2]) != BCRYPT_ROUNDS
 
 
 def generate_access_token(email: str) -> str:
@@ -0,0 +1,109 @@
+"""JSON serialization of ORM objects by response schemas.
+
+Data read from the database is trusted, so instead of validating it with
+pydantic each schema is compiled once into field extractors producing
+values orjson encodes natively.
+"""
+
+from datetime import datetime, timezone
+from operator import attrgetter
+from typing import Callable, get_args, get_origin
+from uuid import UUID
+
+import orjson
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON, ModelField
+from pydantic.validators import (
+	bool_validator, float_validator, int_validator, str_validator
+)
+
+from quicksell.schemas.base import ResponseSchema
+
+schema_serializers = {}
+# as pydantic coerces them, e.g. str fields of numeric columns
+SCALAR_VALIDATORS = (
+	(bool, bool_validator), (str, str_validator),
+	(int, int_validator), (float, float_validator),
+)
+
+
+def timestamp(value) -> datetime:
+	if isinstance(value, datetime):
+		return value
+	return datetime.fromtimestamp(value, timezone.utc)
+
+
+def scalar(type_: type, validator: Callable) -> Callable:
+	return lambda value: value if type(value) is type_ else validator(value)
+
+
+def type_converter(type_) -> Callable:
+	"""Conversion of a value to the JSON type of the schema, None if as is."""
+	if not isinstance(type_, type):
+		return None
+	if issubclass(type_, ResponseSchema):
+		return schema_serializer(type_)
+	if issubclass(type_, BaseModel):  # plain dict in the model
+		names = tuple(type_.__fields__)
+		return lambda value: {name: value[name] for name in names}
+	if issubclass(type_, datetime):
+		return timestamp
+	if issubclass(type_, UUID):
+		return attrgetter('hex')  # as ResponseSchema json_encoders
+	for base, validator in SCALAR_VALIDATORS:
+		if issubclass(type_, base):
+			return scalar(base, validator)
+	return None
+
+
+def field_extractor(schema: type, field: ModelField) -> Callable:
+	getter = attrgetter(field.name)
+	validators = field.pre_validators or ()
+	convert = type_converter(field.type_)
+	if convert and field.shape == SHAPE_LIST:
+		convert_item = convert
+
+		def convert(items):
+			return [convert_item(item) for item in items]
+	elif field.shape not in (SHAPE_SINGLETON, SHAPE_LIST):
+		convert = None
+	if not validators and not convert:
+		return getter
+
+	def extract(obj):
+		value = getter(obj)
+		for validator in validators:
+			value = validator(schema, value, {}, field, schema.__config__)
+		if value is None or convert is None:
+			return value
+		return convert(value)
+	return extract
+
+
+def schema_serializer(schema: type) -> Callable:
+	"""Function making a dict of the schema fields from an ORM object."""
+	if schema not in schema_serializers:
+		fields = tuple(
+			(field.alias, field_extractor(schema, field))
+			for field in schema.__fields__.values()
+		)
+
+		def serialize(obj) -> dict:
+			return {alias: extract(obj) for alias, extract in fields}
+		schema_serializers[schema] = serialize
+	return schema_serializers[schema]
+
+
+def serializer(response_model) -> Callable:
+	"""JSON encoder of objects or lists of objects of the response model.
+
+	None if the model isn't a ResponseSchema or a list of them.
+	"""
+	many = get_origin(response_model) is list
+	schema = get_args(response_model)[0] if many else response_model
+	if not isinstance(schema, type) or not issubclass(schema, ResponseSchema):
+		return None
+	serialize = schema_serializer(schema)
+	if many:
+		return lambda rows: orjson.dumps([serialize(row) for row in rows])
+	return lambda obj: orjson.dumps(serialize(obj))
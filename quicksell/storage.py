@@ -0,0 +1,169 @@
+"""Media files storage backends.
+
+Files are stored by content: key 'ab/cd/abcd...ef.jpg' is the SHA-256 of
+the file spread over two levels of directories, so a file never changes
+and equal uploads are stored once.
+"""
+
+import os
+import re
+import tempfile
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from os import environ
+
+import boto3
+from botocore.exceptions import ClientError
+from starlette.concurrency import run_in_threadpool
+
+from quicksell.models import MediaFile
+
+MEDIA_DIR = 'media'
+IMMUTABLE = 'public, max-age=31536000, immutable'  # Cache-Control
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp'}
+
+
+def content_key(digest: str, extension: str) -> str:
+	return f'{digest[:2]}/{digest[2:4]}/{digest}.{extension}'
+
+
+def is_media_key(key: str) -> bool:
+	"""Key of a stored file or its variant, also safe as a relative path."""
+	return re.match(MediaFile.KEY_PATTERN, key) is not None
+
+
+def content_type(key: str) -> str:
+	return CONTENT_TYPES.get(key.rsplit('.', 1)[-1], 'application/octet-stream')
+
+
+class Storage(ABC):
+	"""Files stored by key."""
+
+	@abstractmethod
+	async def exists(self, key: str) -> bool:
+		"""Whether the file is stored."""
+
+	@abstractmethod
+	async def save(self, path: str, key: str):
+		"""Move complete local file to the storage."""
+
+	@abstractmethod
+	async def delete(self, keys: list[str]):
+		"""Delete files, missing ones are skipped."""
+
+	@abstractmethod
+	def local_copy(self, key: str):
+		"""Async context manager of the file's local path, for reading."""
+
+	def url(self, key: str) -> str:
+		"""URL the file is downloaded from, None if it's served by the app."""
+		return None
+
+
+class LocalStorage(Storage):
+	"""Directory tree on local filesystem."""
+
+	def __init__(self, root: str):
+		self.root = root
+
+	def path(self, key: str) -> str:
+		return os.path.join(self.root, key)
+
+	async def exists(self, key):
+		return await run_in_threadpool(os.path.exists, self.path(key))
+
+	async def save(self, path, key):
+		await run_in_threadpool(self.move, path, key)
+
+	def move(self, path: str, key: str):
+		target = self.path(key)
+		os.makedirs(os.path.dirname(target), exist_ok=True)
+		os.replace(path, target)
+
+	async def delete(self, keys):
+		await run_in_threadpool(self.remove, keys)
+
+	def remove(self, keys: list[str]):
+		for key in keys:
+			try:
+				os.remove(self.path(key))
+			except FileNotFoundError:
+				pass
+
+	@asynccontextmanager
+	async def local_copy(self, key):
+		yield self.path(key)
+
+
+class S3Storage(Storage):
+	"""Bucket of S3 compatible storage, MinIO for local development.
+
+	Credentials are read by boto3 from AWS_* environment variables.
+	"""
+
+	MAX_DELETE = 1000  # keys per DeleteObjects request
+	URL_EXPIRES = 24 * 3600
+
+	def __init__(self, bucket: str, endpoint_url: str = None):
+		self.client = boto3.client('s3', endpoint_url=endpoint_url)
+		self.bucket = bucket
+
+	async def exists(self, key):
+		try:
+			await run_in_threadpool(
+				self.client.head_object, Bucket=self.bucket, Key=key
+			)
+		except ClientError as e:
+			if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+				return False
+			raise
+		return True
+
+	async def save(self, path, key):
+		await run_in_threadpool(
+			self.client.upload_file, path, self.bucket, key,
+			ExtraArgs={
+				'ContentType': content_type(key),
+				'CacheControl': IMMUTABLE
+			}
+		)
+		await run_in_threadpool(os.remove, path)
+
+	async def delete(self, keys):
+		for start in range(0, len(keys), self.MAX_DELETE):
+			await run_in_threadpool(
+				self.client.delete_objects, Bucket=self.bucket, Delete={
+					'Objects': [
+						{'Key': key} for key in keys[start:start + self.MAX_DELETE]
+					],
+					'Quiet': True
+				}
+			)
+
+	@asynccontextmanager
+	async def local_copy(self, key):
+		descriptor, path = tempfile.mkstemp()
+		os.close(descriptor)
+		try:
+			await run_in_threadpool(
+				self.client.download_file, self.bucket, key, path
+			)
+			yield path
+		finally:
+			os.remove(path)
+
+	def url(self, key):
+		# signed locally, no request is made
+		return self.client.generate_presigned_url(
+			'get_object', Params={'Bucket': self.bucket, 'Key': key},
+			ExpiresIn=self.URL_EXPIRES
+		)
+
+
+def default_storage() -> Storage:
+	if environ.get('MEDIA_STORAGE', 'local') == 's3':
+		return S3Storage(environ['S3_BUCKET'], environ.get('S3_ENDPOINT_URL'))
+	return LocalStorage(MEDIA_DIR)
+
+
+storage = default_storage()